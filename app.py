@@ -1,651 +1,2341 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file
+from flask import Flask, Request, render_template, request, redirect, url_for, send_from_directory, jsonify, abort
+import collections
+import contextlib
+import cProfile
+import functools
+import gzip
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import os
-from openpyxl import load_workbook
+from openpyxl import Workbook, load_workbook
+from werkzeug.utils import secure_filename
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, the job queue is then only locked within a server process
+    fcntl = None
 
 app = Flask(__name__)
+
+# Structured metrics log: one JSON line per finished stage and run, on its own logger so it is written at INFO
+# whatever level the app logger runs at (METRICS_LOG_LEVEL=WARNING turns it off)
+METRICS_LOGGER = logging.getLogger('metrics')
+METRICS_LOGGER.setLevel(os.environ.get('METRICS_LOG_LEVEL', 'INFO'))
+METRICS_LOGGER.propagate = False
+if not METRICS_LOGGER.handlers:
+    _metrics_handler = logging.StreamHandler()
+    _metrics_handler.setFormatter(logging.Formatter('%(message)s'))
+    METRICS_LOGGER.addHandler(_metrics_handler)
+
+
+# Stream of an upload, held in memory up to UPLOAD_SPOOL_BYTES and spooled to a temporary file above it
+# An upload handed over to a job outlives its request: closing the request leaves it open, the job releases it
+class UploadStream(tempfile.SpooledTemporaryFile):
+    handed_over = False
+
+    def close(self):
+        if not self.handed_over:
+            super().close()
+
+    def release(self):
+        self.handed_over = False
+        self.close()
+
+
+# Uploads are parsed straight from their streams by the processing job
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadStream(max_size=app.config['UPLOAD_SPOOL_BYTES'], mode='rb+')
+
+
+app.request_class = UploadRequest
+app.config['UPLOAD_SPOOL_BYTES'] = int(os.environ.get('UPLOAD_SPOOL_BYTES', 64 * 1024 * 1024))
+# Uploads parsed from their streams are saved to their workspace after the run, for the workspace routes
+# (/process, /quote and /sweep of the workspace); KEEP_UPLOADS=0 only keeps the outputs
+app.config['KEEP_UPLOADS'] = os.environ.get('KEEP_UPLOADS', '1') not in ('', '0')
+# Number of processing jobs running at the same time, and how many may be running or waiting in total
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_QUEUE_SIZE'] = int(os.environ.get('JOB_QUEUE_SIZE', 8))
+# Number of carriers a job recalculates in parallel worker processes (1 runs them in the job thread)
+app.config['CARRIER_WORKERS'] = int(os.environ.get('CARRIER_WORKERS',
+                                                   max(1, (os.cpu_count() or 1) // app.config['JOB_WORKERS'])))
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-def load_workbook_once(output_file):
-    return load_workbook(output_file)
-
-
+# Parsed and indexed price lists, keyed by the content hash of the price list file
+PRICE_CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'price_cache')
+os.makedirs(PRICE_CACHE_FOLDER, exist_ok=True)
+# Bump when the cached LaneIndex layout or the price list normalization changes
+PRICE_CACHE_VERSION = 3
+app.config['PRICE_CACHE_MAX_BYTES'] = int(os.environ.get('PRICE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+# Long results of one carrier, keyed by the content hashes of the historic file and the carrier's price list,
+# so a re-run after some carriers revised their rates only recalculates the changed carriers
+RESULT_CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'result_cache')
+os.makedirs(RESULT_CACHE_FOLDER, exist_ok=True)
+# Bump when the recalculation or the layout of the long results changes
+RESULT_CACHE_VERSION = 1
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 4 * 1024 * 1024 * 1024))
+
+# Number of rows converted to cells at a time when writing the main sheet
+WRITE_CHUNK_SIZE = 10000
+
+# Rows of an Excel sheet including the header, longer results continue on another sheet
+EXCEL_MAX_ROWS = 1048576
+
+# Output formats of the results file with their extension, the default is used when a run does not choose one
+OUTPUT_FORMATS = {'xlsx': '.xlsx', 'csv': '.csv', 'csv.gz': '.csv.gz', 'parquet': '.parquet'}
+app.config['OUTPUT_FORMAT'] = os.environ.get('OUTPUT_FORMAT', 'xlsx')
+
+# Lane lookup modes: exact lanes only, or a missing lane with a postal side falls back to the longest postal prefix
+# quoted in the price list and then to the region; the default is used when a run does not choose one
+LOOKUP_MODES = ['exact', 'fallback']
+app.config['LOOKUP_MODE'] = os.environ.get('LOOKUP_MODE', 'exact')
+# Shortest postal prefix tried by the fallback lookup
+POSTAL_PREFIX_MIN_LENGTH = 2
+OUTPUT_NAME = 'Final_Historic_Cost_per_Carrier_with_Prices'
+SUMMARY_NAME = 'Final_Historic_Cost_per_Carrier_Scenarios'
+CUBE_NAME = 'Final_Historic_Cost_per_Carrier_Cube'
+SWEEP_NAME = 'Final_Historic_Cost_per_Carrier_Sweep'
+
+# Number of most recent jobs listed by the metrics route
+JOB_HISTORY = 100
+
+# Historic files above this size are processed in chunks of HISTORIC_CHUNK_SIZE rows
+app.config['STREAMING_THRESHOLD_BYTES'] = int(os.environ.get('STREAMING_THRESHOLD_BYTES', 100 * 1024 * 1024))
+app.config['HISTORIC_CHUNK_SIZE'] = int(os.environ.get('HISTORIC_CHUNK_SIZE', 100000))
+
+# Price lists kept in memory as quote tables by the quote routes, and the most shipments quoted per request
+app.config['QUOTE_RESIDENT_PRICE_LISTS'] = int(os.environ.get('QUOTE_RESIDENT_PRICE_LISTS', 32))
+app.config['QUOTE_MAX_SHIPMENTS'] = int(os.environ.get('QUOTE_MAX_SHIPMENTS', 1000))
+
+# Most price adjustment points a tariff sensitivity sweep evaluates
+app.config['SWEEP_MAX_POINTS'] = int(os.environ.get('SWEEP_MAX_POINTS', 500))
+
+# Sharded runs split the historic file into shards by row range (SHARD_ROWS rows each) or by a hash of the
+# Shipment ID (SHARD_COUNT shards), processed by SHARD_WORKERS independent worker processes (by default the cores
+# shared out between the JOB_WORKERS jobs running at once); the default mode is used when a run does not choose one
+# ('' processes the file as a whole)
+SHARD_MODES = ['range', 'hash']
+app.config['SHARD_MODE'] = os.environ.get('SHARD_MODE', '')
+app.config['SHARD_ROWS'] = int(os.environ.get('SHARD_ROWS', 1000000))
+app.config['SHARD_WORKERS'] = int(os.environ.get('SHARD_WORKERS',
+                                                 max(1, (os.cpu_count() or 1) // app.config['JOB_WORKERS'])))
+app.config['SHARD_COUNT'] = int(os.environ.get('SHARD_COUNT', app.config['SHARD_WORKERS']))
+
+# Every run profiles its job thread with cProfile when PROFILE_RUNS is set
+app.config['PROFILE_RUNS'] = os.environ.get('PROFILE_RUNS', '') not in ('', '0')
+
+# Every upload gets its own workspace folder for its inputs and the outputs of its runs
+WORKSPACE_FOLDER = os.path.join(UPLOAD_FOLDER, 'workspaces')
+os.makedirs(WORKSPACE_FOLDER, exist_ok=True)
+# Marker file of a workspace with a running job, the reaper leaves it alone
+RUNNING_MARKER = '.running'
+# Workspaces unused for longer than the maximum age are removed, and the least recently used ones
+# beyond the disk quota, checked every reap interval (the price list cache is kept)
+app.config['WORKSPACE_MAX_AGE_SECONDS'] = int(os.environ.get('WORKSPACE_MAX_AGE_SECONDS', 24 * 60 * 60))
+app.config['WORKSPACE_QUOTA_BYTES'] = int(os.environ.get('WORKSPACE_QUOTA_BYTES', 10 * 1024 * 1024 * 1024))
+app.config['WORKSPACE_REAP_INTERVAL_SECONDS'] = int(os.environ.get('WORKSPACE_REAP_INTERVAL_SECONDS', 10 * 60))
+
+
+# Helper function to get the folder of a workspace, 404 for anything that is not a workspace ID
+def workspace_path(workspace_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', workspace_id):
+        abort(404)
+    return os.path.join(WORKSPACE_FOLDER, workspace_id)
+
+
+# Function to create a new workspace, the reaper is started with the first one
+def create_workspace():
+    start_workspace_reaper()
+    workspace_id = uuid.uuid4().hex
+    os.makedirs(workspace_path(workspace_id))
+    return workspace_id
+
+
+# Helper function to save an uploaded file in a workspace under a safe name that is unique in the workspace
+def save_upload(upload, folder):
+    filename = secure_filename(upload.filename) or 'upload'
+    candidate, n = filename, 1
+    while os.path.exists(os.path.join(folder, candidate)):
+        n += 1
+        candidate = f'{n}_{filename}'
+    upload.stream.seek(0)
+    upload.save(os.path.join(folder, candidate))
+    return candidate
+
+
+# Helper function returning the size in bytes of a workspace and the time its last file was modified
+def workspace_usage(path):
+    size, last_used = 0, os.stat(path).st_mtime
+    for folder, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(folder, name))
+            except FileNotFoundError:
+                continue
+            size += stat.st_size
+            last_used = max(last_used, stat.st_mtime)
+    return size, last_used
+
+
+# Function to remove the workspaces unused for longer than the maximum age, then the least recently used
+# ones until the workspaces fit in the disk quota; workspaces with a running job are kept
+def reap_workspaces():
+    now = time.time()
+    max_age = app.config['WORKSPACE_MAX_AGE_SECONDS']
+
+    workspaces = []
+    for entry in os.scandir(WORKSPACE_FOLDER):
+        if not entry.is_dir():
+            continue
+        try:
+            size, last_used = workspace_usage(entry.path)
+            # A marker older than the maximum age is left behind by a crashed process
+            running = now - os.stat(os.path.join(entry.path, RUNNING_MARKER)).st_mtime < max_age
+        except FileNotFoundError:
+            running = False
+        workspaces.append((last_used, size, entry.path, running))
+
+    total_size = sum(size for _, size, _, _ in workspaces)
+    for last_used, size, path, running in sorted(workspaces):
+        if running:
+            continue
+        if now - last_used > max_age or total_size > app.config['WORKSPACE_QUOTA_BYTES']:
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+            app.logger.info(f'Removed workspace {os.path.basename(path)} ({size} bytes)')
+
+
+# Background thread reaping the workspaces at every reap interval
+def workspace_reaper():
+    while True:
+        try:
+            reap_workspaces()
+        except Exception:
+            app.logger.exception('Reaping the workspaces failed')
+        time.sleep(app.config['WORKSPACE_REAP_INTERVAL_SECONDS'])
+
+
+REAPER_LOCK = threading.Lock()
+REAPER_THREAD = None
+
+
+def start_workspace_reaper():
+    global REAPER_THREAD
+    with REAPER_LOCK:
+        if REAPER_THREAD is None:
+            REAPER_THREAD = threading.Thread(target=workspace_reaper, name='workspace-reaper', daemon=True)
+            REAPER_THREAD.start()
+
+
+# Helper function to get the size of an uploaded file from its spooled stream
+def upload_size(upload):
+    upload.stream.seek(0, os.SEEK_END)
+    size = upload.stream.tell()
+    upload.stream.seek(0)
+    return size
+
+
+# Upload Route: the spooled uploads are handed to a processing job that parses them from their streams, only a
+# historic file processed in chunks or shards is saved to the workspace first, as those reread it
 @app.route('/', methods=['GET', 'POST'])
 def upload_files():
     if request.method == 'POST':
-        # Save the Historic Cost File
-        historic_file = request.files['historic_cost']
-        historic_path = os.path.join(UPLOAD_FOLDER, historic_file.filename)
-        historic_file.save(historic_path)
-
-        # Save up to four Price List files
-        price_list_paths = []
-        for i in range(1, 5):
-            price_list_file = request.files.get(f'price_list_{i}')
-            if price_list_file:
-                path = os.path.join(UPLOAD_FOLDER, price_list_file.filename)
-                price_list_file.save(path)
-                price_list_paths.append(path)
-
-        # Redirect to processing route
-        return redirect(url_for('process_files', historic_file=historic_file.filename,
-                                price_list_files=','.join([os.path.basename(p) for p in price_list_paths])))
+        output_format, lookup_mode, shard_mode, plan, error = run_options()
+        if error:
+            return error, 400
+
+        # The numbered price_list_<i> fields in order, then any number of files uploaded in the price_lists field
+        historic_upload = request.files['historic_cost']
+        numbered_fields = sorted((field for field in request.files if re.fullmatch(r'price_list_\d+', field)),
+                                 key=lambda field: int(field.rsplit('_', 1)[1]))
+        price_list_uploads = [upload for upload in [request.files[field] for field in numbered_fields] +
+                              request.files.getlist('price_lists') if upload]
+        if not price_list_uploads:
+            return 'At least one price list is needed', 400
+
+        # The outputs go to a new workspace, so concurrent runs never see each other's files
+        workspace_id = create_workspace()
+
+        if shard_mode or upload_size(historic_upload) > app.config['STREAMING_THRESHOLD_BYTES']:
+            workspace = workspace_path(workspace_id)
+            historic_file = save_upload(historic_upload, workspace)
+            saved_price_lists = [save_upload(upload, workspace) for upload in price_list_uploads]
+            return start_processing(workspace, workspace_id, historic_file, ','.join(saved_price_lists))
+
+        uploads = [historic_upload] + price_list_uploads
+        for upload in uploads:
+            upload.stream.handed_over = True
+        profile = app.config['PROFILE_RUNS'] or request.values.get('profile') == '1'
+        job = submit_job(process_uploads, workspace_id, historic_upload, price_list_uploads, output_format,
+                         lookup_mode, plan, workspace_id=workspace_id, profile=profile)
+        if job is None:
+            for upload in uploads:
+                upload.stream.release()
+            return 'Too many processing jobs are queued, please try again later', 503
+        return redirect(url_for('job_results', job_id=job.id))
 
     return render_template('upload_new.html')
 
 
-# Helper function to calculate the cost and return the price used for the calculation
-def calculate_cost_and_price(row, price_df, rate_type):
-    # Construct the lane based on each Rate Geography type
-    if rate_type == 'CITY-CITY':
-        lane = f"{row['Source City']}-{row['Destination City']}"
-    elif rate_type == 'POSTAL-POSTAL':
-        lane = f"{row['Source Postal']}-{row['Destination Postal']}"
-    elif rate_type == 'REGION-REGION':
-        lane = f"{row['Source Region']}-{row['Destination Region']}"
-    elif rate_type == 'LOCATION-LOCATION':
-        lane = f"{row['Source Location']}-{row['Destination Location']}"
-    elif rate_type == 'CITY-POSTAL':
-        lane = f"{row['Source City']}-{row['Destination Postal']}"
-    elif rate_type == 'CITY-REGION':
-        lane = f"{row['Source City']}-{row['Destination Region']}"
-    elif rate_type == 'CITY-LOCATION':
-        lane = f"{row['Source City']}-{row['Destination Location']}"
-    elif rate_type == 'POSTAL-CITY':
-        lane = f"{row['Source Postal']}-{row['Destination City']}"
-    elif rate_type == 'POSTAL-REGION':
-        lane = f"{row['Source Postal']}-{row['Destination Region']}"
-    elif rate_type == 'POSTAL-LOCATION':
-        lane = f"{row['Source Postal']}-{row['Destination Location']}"
-    elif rate_type == 'REGION-CITY':
-        lane = f"{row['Source Region']}-{row['Destination City']}"
-    elif rate_type == 'REGION-POSTAL':
-        lane = f"{row['Source Region']}-{row['Destination Postal']}"
-    elif rate_type == 'REGION-LOCATION':
-        lane = f"{row['Source Region']}-{row['Destination Location']}"
-    elif rate_type == 'LOCATION-CITY':
-        lane = f"{row['Source Location']}-{row['Destination City']}"
-    elif rate_type == 'LOCATION-POSTAL':
-        lane = f"{row['Source Location']}-{row['Destination Postal']}"
-    elif rate_type == 'LOCATION-REGION':
-        lane = f"{row['Source Location']}-{row['Destination Region']}"
+# Columns of the Historic Cost file based on the observed structure, in file order, with the type they are read as
+# (locations and codes are text so numeric postal codes match the price list lanes, None lets pandas infer it)
+HISTORIC_COLUMN_TYPES = {
+    'Shipment ID': None, 'Shipment Date': None, 'Carrier': str, 'Mode': str, 'Movement': str,
+    'Source Location': str, 'Source City': str, 'Source Postal': str, 'Source Region': str,
+    'Destination Location': str, 'Destination City': str, 'Destination Postal': str,
+    'Destination Region': str, 'Weight': float, 'Volume': float, 'Loading Meters': float,
+    'Truck Type': str, 'Traveled Distance': float, 'Total Cost': float, 'Rate Geography': str,
+    'Cost Type': str, 'Remarks': str, 'User Own Reference': str
+}
+
+# Columns of a price list used by the recalculation, with the type they are read as
+PRICE_LIST_COLUMN_TYPES = {'SOURCE': str, 'DESTINATION': str, 'Cost Type': str, 'Truck Type': str, 'Price': float}
+
+# Use the much faster calamine engine for Excel files when it is installed
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = None
+
+
+# Helper function to detect whether an input file is Excel, CSV or Parquet, from its extension or its first bytes
+# (the source is a path or an uploaded stream, whose extension comes from its file name)
+def detect_format(source, filename=None):
+    extension = os.path.splitext(filename or (source if isinstance(source, str) else ''))[1].lower()
+    if extension in ('.csv', '.txt'):
+        return 'csv'
+    if extension in ('.parquet', '.pq'):
+        return 'parquet'
+    if extension in ('.xlsx', '.xlsm', '.xls'):
+        return 'excel'
+
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            magic = f.read(8)
     else:
-        lane = "UNKNOWN"  # Default for unsupported or unexpected Rate Geographies
-
-    # Filter the price based on Lane and Adjusted Cost Type
-    price_row = price_df[(price_df['Lane'] == lane) & (price_df['Adjusted Cost Type'] == row['Adjusted Cost Type'])]
-
-    # Return the calculated cost and the price used
-    if not price_row.empty:
-        price = price_row.iloc[0]['Price']
-        if row['Cost Type'] == 'KM':
-            return row['Traveled Distance'] * price, price
-        elif row['Cost Type'] == 'KG':
-            return row['Weight'] * price, price
-        else:
-            return price, price
-    return None, None
-
-
-
-# Function to create a summary of costs for each carrier using dynamically generated carrier names
-def create_carrier_summary(output_file, df):
-    # Load the workbook and access the main sheet (where recalculated costs are saved)
-    wb = load_workbook(output_file)
-    main_sheet = wb.active  # Assuming the main sheet is the active one
-
-    # Create a new sheet for the summary
-    if "Scenario1-Best_Carrier" in wb.sheetnames:
-        del wb["Scenario1-Best_Carrier"]  # Remove if it exists (optional)
-    ws = wb.create_sheet("Scenario1-Best_Carrier")  # Renamed to Scenario1-Best_Carrier
-
-    # Set up headers for Historic Cost, Carrier Name, Recalculated Cost, Difference, Rank, and % Difference
-    ws['B1'] = 'Total Historic Cost'
-    ws['C1'] = 'Carrier Name'
-    ws['D1'] = 'Total Recalculated Cost'
-    ws['E1'] = 'Total Difference'
-    ws['F1'] = 'Rank'
-    ws['G1'] = '% Difference'
-
-    # Sum the Historic Cost (assuming 'Total Cost' exists in the DataFrame as 'Total Cost' column)
-    total_historic_cost = df['Total Cost'].sum()
-    ws['B2'] = total_historic_cost
-
-    # Get dynamically generated carrier names from the DataFrame (assuming they have '_Recalculated_Cost' suffix)
-    carrier_columns = [col for col in df.columns if '_Recalculated_Cost' in col]
-
-    # Prepare a list to store carrier data (to rank them later)
-    carrier_data = []
-
-    # Loop through the carrier columns to calculate the total recalculated cost and difference
-    for idx, col_name in enumerate(carrier_columns, start=2):
-        carrier_name = col_name.replace('_Recalculated_Cost', '')  # Extract carrier name from column name
-        total_recalculated_cost = df[col_name].sum()  # Sum the recalculated costs for each carrier
-
-        # Calculate the difference between the total historic cost and recalculated cost
-        total_difference = total_recalculated_cost - total_historic_cost
-
-        # Calculate % Difference (Total Difference / Total Historic Cost)
-        percent_difference = (total_difference / total_historic_cost) * 100
-
-        # Store the data for later ranking
-        carrier_data.append({
-            'carrier_name': carrier_name,
-            'total_recalculated_cost': total_recalculated_cost,
-            'total_difference': total_difference,
-            'percent_difference': percent_difference
-        })
-
-    # Rank the carriers based on the total recalculated cost (ascending order)
-    carrier_data = sorted(carrier_data, key=lambda x: x['total_recalculated_cost'])
-
-    # Populate the summary sheet with ranked data
-    for idx, carrier in enumerate(carrier_data, start=2):
-        ws[f'C{idx}'] = carrier['carrier_name']  # Carrier Name
-        ws[f'D{idx}'] = carrier['total_recalculated_cost']  # Total Recalculated Cost
-        ws[f'E{idx}'] = carrier['total_difference']  # Total Difference
-        ws[f'F{idx}'] = idx - 1  # Rank
-        ws[f'G{idx}'] = carrier['percent_difference']  # % Difference
-
-    # Save the workbook with the new summary sheet
-    wb.save(output_file)
-
-# Function to create a summary for "Scenario2-BC_Simulation" using Minimum_Simulation_Cost
-def create_carrier_simulation_summary(output_file, df):
-    # Load the workbook and access the main sheet (where recalculated costs are saved)
-    wb = load_workbook(output_file)
-    main_sheet = wb.active  # Assuming the main sheet is the active one
-
-    # Create a new sheet for the summary
-    if "Scenario2-BC_Simulation" in wb.sheetnames:
-        del wb["Scenario2-BC_Simulation"]  # Remove if it exists (optional)
-    ws = wb.create_sheet("Scenario2-BC_Simulation")  # Renamed to Scenario2-BC_Simulation
-
-    # Set up headers for Historic Cost, Carrier Name, Minimum Simulation Cost, Difference, Rank, and % Difference
-    ws['B1'] = 'Total Historic Cost'
-    ws['C1'] = 'Carrier Name'
-    ws['D1'] = 'Minimum Simulation Cost'
-    ws['E1'] = 'Total Difference'
-    ws['F1'] = 'Rank'
-    ws['G1'] = '% Difference'
-
-    # Sum the Historic Cost (assuming 'Total Cost' exists in the DataFrame as 'Total Cost' column)
-    total_historic_cost = df['Total Cost'].sum()
-    ws['B2'] = total_historic_cost
-
-    # Get dynamically generated carrier names from the DataFrame (assuming they have '_Minimum_Simulation_Cost' suffix)
-    carrier_columns = [col for col in df.columns if '_Minimum_Simulation_Cost' in col]
-
-    # Prepare a list to store carrier data (to rank them later)
-    carrier_data = []
-
-    # Loop through the carrier columns to calculate the total Minimum Simulation Cost and difference
-    for idx, col_name in enumerate(carrier_columns, start=2):
-        carrier_name = col_name.replace('_Minimum_Simulation_Cost', '')  # Extract carrier name from column name
-        total_simulation_cost = df[col_name].sum()  # Sum the Minimum Simulation Costs for each carrier
-
-        # Calculate the difference between the total historic cost and minimum simulation cost
-        total_difference = total_simulation_cost - total_historic_cost
-
-        # Calculate % Difference (Total Difference / Total Historic Cost)
-        percent_difference = (total_difference / total_historic_cost) * 100
-
-        # Store the data for later ranking
-        carrier_data.append({
-            'carrier_name': carrier_name,
-            'total_simulation_cost': total_simulation_cost,
-            'total_difference': total_difference,
-            'percent_difference': percent_difference
-        })
-
-    # Rank the carriers based on the total simulation cost (ascending order)
-    carrier_data = sorted(carrier_data, key=lambda x: x['total_simulation_cost'])
-
-    # Populate the summary sheet with ranked data
-    for idx, carrier in enumerate(carrier_data, start=2):
-        ws[f'C{idx}'] = carrier['carrier_name']  # Carrier Name
-        ws[f'D{idx}'] = carrier['total_simulation_cost']  # Minimum Simulation Cost
-        ws[f'E{idx}'] = carrier['total_difference']  # Total Difference
-        ws[f'F{idx}'] = idx - 1  # Rank
-        ws[f'G{idx}'] = carrier['percent_difference']  # % Difference
-
-    # Save the workbook with the new summary sheet
-    wb.save(output_file)
-
-
-# Function to create a summary for "Scenario3-Best_Mode" with a breakdown by Mode using Total Recalculated Cost
-def create_mode_summary(output_file, df):
-    # Load the workbook and access the main sheet (where recalculated costs are saved)
-    wb = load_workbook(output_file)
-    main_sheet = wb.active  # Assuming the main sheet is the active one
-
-    # Create a new sheet for the summary
-    if "Scenario3-Best_Mode" in wb.sheetnames:
-        del wb["Scenario3-Best_Mode"]  # Remove if it exists (optional)
-    ws = wb.create_sheet("Scenario3-Best_Mode")  # New sheet for Best Mode breakdown
-
-    # Set up headers for Mode, Historic Cost, Carrier Name, Total Recalculated Cost, Difference, Rank, and % Difference
-    ws['B1'] = 'Mode'
-    ws['C1'] = 'Total Historic Cost'
-    ws['D1'] = 'Carrier Name'
-    ws['E1'] = 'Total Recalculated Cost'
-    ws['F1'] = 'Total Difference'
-    ws['G1'] = 'Rank'
-    ws['H1'] = '% Difference'
-
-    # Group by Mode and perform calculations for each mode
-    unique_modes = df['Mode'].unique()
-
-    row_idx = 2  # Start populating from row 2
-    for mode in unique_modes:
-        mode_df = df[df['Mode'] == mode]  # Filter the DataFrame by Mode
-
-        # Sum the Historic Cost for the current mode
-        total_historic_cost = mode_df['Total Cost'].sum()
-
-        # Get dynamically generated carrier names from the DataFrame (assuming they have '_Recalculated_Cost' suffix)
-        carrier_columns = [col for col in mode_df.columns if '_Recalculated_Cost' in col]
-
-        # Prepare a list to store carrier data (to rank them later)
-        carrier_data = []
-
-        # Loop through the carrier columns to calculate the total Recalculated Cost and difference
-        for col_name in carrier_columns:
-            carrier_name = col_name.replace('_Recalculated_Cost', '')  # Extract carrier name from column name
-            total_recalculated_cost = mode_df[col_name].sum()  # Sum the Total Recalculated Costs for each carrier
-
-            # Calculate the difference between the total historic cost and recalculated cost
-            total_difference = total_recalculated_cost - total_historic_cost
-
-            # Calculate % Difference (Total Difference / Total Historic Cost)
-            percent_difference = (total_difference / total_historic_cost) * 100
-
-            # Store the data for later ranking
-            carrier_data.append({
-                'carrier_name': carrier_name,
-                'total_recalculated_cost': total_recalculated_cost,
-                'total_difference': total_difference,
-                'percent_difference': percent_difference
-            })
-
-        # Rank the carriers based on the total recalculated cost (ascending order)
-        carrier_data = sorted(carrier_data, key=lambda x: x['total_recalculated_cost'])
-
-        # Populate the summary sheet with ranked data for the current mode
-        mode_filled = False  # Used to control when to fill the mode label
-        cost_filled = False  # Used to control when to fill the historic cost
-        for idx, carrier in enumerate(carrier_data):
-            # Only write the mode for the first row of each group
-            if not mode_filled:
-                ws[f'B{row_idx}'] = mode  # Mode
-                mode_filled = True  # Mode label filled once per group
-
-            # Only write the total historic cost for the first row of each group
-            if not cost_filled:
-                ws[f'C{row_idx}'] = total_historic_cost  # Total Historic Cost
-                cost_filled = True  # Total Historic Cost filled once per group
-
-            ws[f'D{row_idx}'] = carrier['carrier_name']  # Carrier Name
-            ws[f'E{row_idx}'] = carrier['total_recalculated_cost']  # Total Recalculated Cost
-            ws[f'F{row_idx}'] = carrier['total_difference']  # Total Difference
-            ws[f'G{row_idx}'] = idx + 1  # Rank
-            ws[f'H{row_idx}'] = carrier['percent_difference']  # % Difference
-            row_idx += 1
-
-    # Save the workbook with the new summary sheet
-    wb.save(output_file)
-
-# Function to create a summary for "Scenario4-BM_Simulation" with a breakdown by Mode using Minimum Simulation Cost
-def create_bm_simulation_summary(output_file, df):
-    # Load the workbook and access the main sheet (where recalculated costs are saved)
-    wb = load_workbook(output_file)
-    main_sheet = wb.active  # Assuming the main sheet is the active one
-
-    # Create a new sheet for the summary
-    if "Scenario4-BM_Simulation" in wb.sheetnames:
-        del wb["Scenario4-BM_Simulation"]  # Remove if it exists (optional)
-    ws = wb.create_sheet("Scenario4-BM_Simulation")  # New sheet for BM Simulation breakdown
-
-    # Set up headers for Mode, Historic Cost, Carrier Name, Minimum Simulation Cost, Difference, Rank, and % Difference
-    ws['B1'] = 'Mode'
-    ws['C1'] = 'Total Historic Cost'
-    ws['D1'] = 'Carrier Name'
-    ws['E1'] = 'Minimum Simulation Cost'
-    ws['F1'] = 'Total Difference'
-    ws['G1'] = 'Rank'
-    ws['H1'] = '% Difference'
-
-    # Group by Mode and perform calculations for each mode
-    unique_modes = df['Mode'].unique()
-
-    row_idx = 2  # Start populating from row 2
-    for mode in unique_modes:
-        mode_df = df[df['Mode'] == mode]  # Filter the DataFrame by Mode
-
-        # Sum the Historic Cost for the current mode
-        total_historic_cost = mode_df['Total Cost'].sum()
-
-        # Get dynamically generated carrier names from the DataFrame (assuming they have '_Minimum_Simulation_Cost' suffix)
-        carrier_columns = [col for col in mode_df.columns if '_Minimum_Simulation_Cost' in col]
-
-        # Prepare a list to store carrier data (to rank them later)
-        carrier_data = []
-
-        # Loop through the carrier columns to calculate the total Minimum Simulation Cost and difference
-        for col_name in carrier_columns:
-            carrier_name = col_name.replace('_Minimum_Simulation_Cost', '')  # Extract carrier name from column name
-            total_simulation_cost = mode_df[col_name].sum()  # Sum the Minimum Simulation Costs for each carrier
-
-            # Calculate the difference between the total historic cost and minimum simulation cost
-            total_difference = total_simulation_cost - total_historic_cost
-
-            # Calculate % Difference (Total Difference / Total Historic Cost)
-            percent_difference = (total_difference / total_historic_cost) * 100
-
-            # Store the data for later ranking
-            carrier_data.append({
-                'carrier_name': carrier_name,
-                'total_simulation_cost': total_simulation_cost,
-                'total_difference': total_difference,
-                'percent_difference': percent_difference
-            })
-
-        # Rank the carriers based on the total simulation cost (ascending order)
-        carrier_data = sorted(carrier_data, key=lambda x: x['total_simulation_cost'])
-
-        # Populate the summary sheet with ranked data for the current mode
-        mode_filled = False  # Used to control when to fill the mode label
-        cost_filled = False  # Used to control when to fill the historic cost
-        for idx, carrier in enumerate(carrier_data):
-            # Only write the mode for the first row of each group
-            if not mode_filled:
-                ws[f'B{row_idx}'] = mode  # Mode
-                mode_filled = True  # Mode label filled once per group
-
-            # Only write the total historic cost for the first row of each group
-            if not cost_filled:
-                ws[f'C{row_idx}'] = total_historic_cost  # Total Historic Cost
-                cost_filled = True  # Total Historic Cost filled once per group
-
-            ws[f'D{row_idx}'] = carrier['carrier_name']  # Carrier Name
-            ws[f'E{row_idx}'] = carrier['total_simulation_cost']  # Minimum Simulation Cost
-            ws[f'F{row_idx}'] = carrier['total_difference']  # Total Difference
-            ws[f'G{row_idx}'] = idx + 1  # Rank
-            ws[f'H{row_idx}'] = carrier['percent_difference']  # % Difference
-            row_idx += 1
-
-    # Save the workbook with the new summary sheet
-    wb.save(output_file)
-
-
-# Function to create a summary for "Scenario5-Best_Movement" with a breakdown by Movement using Total Recalculated Cost
-def create_best_movement_summary(output_file, df):
-    wb = load_workbook(output_file)
-    main_sheet = wb.active
-
-    if "Scenario5-Best_Movement" in wb.sheetnames:
-        del wb["Scenario5-Best_Movement"]
-    ws = wb.create_sheet("Scenario5-Best_Movement")
-
-    ws['B1'] = 'Movement'
-    ws['C1'] = 'Total Historic Cost'
-    ws['D1'] = 'Carrier Name'
-    ws['E1'] = 'Total Recalculated Cost'
-    ws['F1'] = 'Total Difference'
-    ws['G1'] = 'Rank'
-    ws['H1'] = '% Difference'
-
-    unique_movements = df['Movement'].unique()
-    row_idx = 2
-
-    for movement in unique_movements:
-        movement_df = df[df['Movement'] == movement]
-        total_historic_cost = movement_df['Total Cost'].sum()
-        carrier_columns = [col for col in movement_df.columns if '_Recalculated_Cost' in col]
+        position = source.tell()
+        magic = source.read(8)
+        source.seek(position)
+    if magic.startswith(b'PAR1'):
+        return 'parquet'
+    if magic.startswith((b'PK', b'\xd0\xcf\x11\xe0')):
+        return 'excel'
+    return 'csv'
+
+
+# Function to read the Historic Cost file with the custom column names, only the expected columns are parsed
+def read_historic_file(path, filename=None):
+    names = list(HISTORIC_COLUMN_TYPES)
+    dtype = {name: column_type for name, column_type in HISTORIC_COLUMN_TYPES.items() if column_type is not None}
+    usecols = list(range(len(names)))
+
+    file_format = detect_format(path, filename)
+    if file_format == 'csv':
+        return pd.read_csv(path, header=0, names=names, usecols=usecols, dtype=dtype, parse_dates=['Shipment Date'])
+    if file_format == 'parquet':
+        historic_df = pd.read_parquet(path).iloc[:, usecols]
+        historic_df.columns = names
+        return historic_df.astype(dtype)
+    return pd.read_excel(path, engine=EXCEL_ENGINE, header=0, names=names, usecols=usecols, dtype=dtype)
+
+
+# Function to read the columns of a price list used by the recalculation
+def read_price_list(path, filename=None):
+    columns = list(PRICE_LIST_COLUMN_TYPES)
+
+    file_format = detect_format(path, filename)
+    if file_format == 'csv':
+        return pd.read_csv(path, usecols=columns, dtype=PRICE_LIST_COLUMN_TYPES)
+    if file_format == 'parquet':
+        return pd.read_parquet(path, columns=columns).astype(PRICE_LIST_COLUMN_TYPES)
+    return pd.read_excel(path, engine=EXCEL_ENGINE, usecols=columns, dtype=PRICE_LIST_COLUMN_TYPES)
+
+
+# Function to read the Historic Cost file in chunks of rows, typed and named like read_historic_file
+def iter_historic_chunks(path, chunk_size):
+    names = list(HISTORIC_COLUMN_TYPES)
+    dtype = {name: column_type for name, column_type in HISTORIC_COLUMN_TYPES.items() if column_type is not None}
+    usecols = list(range(len(names)))
+
+    file_format = detect_format(path)
+    if file_format == 'csv':
+        yield from pd.read_csv(path, header=0, names=names, usecols=usecols, dtype=dtype,
+                               parse_dates=['Shipment Date'], chunksize=chunk_size)
+        return
+
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        batches = (batch.to_pandas().iloc[:, usecols] for batch in pq.ParquetFile(path).iter_batches(chunk_size))
+    else:
+        # Read-only openpyxl workbooks load rows lazily
+        wb = load_workbook(path, read_only=True, data_only=True)
+        rows = wb.active.iter_rows(min_row=2, max_col=len(names), values_only=True)
+        batches = (pd.DataFrame(batch, columns=names, dtype=object)
+                   for batch in iter(lambda: list(itertools.islice(rows, chunk_size)), []))
+
+    start = 0
+    for batch in batches:
+        batch.columns = names
+        batch.index = pd.RangeIndex(start, start + len(batch))
+        start += len(batch)
+        yield batch.astype(dtype)
+
+
+# Progress callback used when nobody is polling the processing stages
+def no_progress(**fields):
+    pass
+
+
+# Helper function returning the current resident memory in MB of this process, None where /proc is not available
+# (unlike the ru_maxrss high-water mark it tells the stages of a long-running server apart)
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Wall time, memory, row counts and lookup hit rates of one processing run
+# Every finished stage is logged as a JSON line, the collected metrics are served by the metrics routes
+class RunMetrics:
+    def __init__(self, run_id=None):
+        self.run_id = run_id
+        self.started = time.time()
+        self.seconds = None
+        self.stages = {}
+        self.lookups = {}
+        self.reused_results = {}  # Carrier results (or chunks of them) taken from the result cache
+        self.profile_file = None
+        self.lock = threading.Lock()  # The metrics routes read the metrics while the job thread fills them
+
+    # Context manager timing a stage, a stage run once per chunk adds up over the chunks
+    @contextlib.contextmanager
+    def stage(self, name, rows=0):
+        counts = {'rows': rows}  # Stages that only know their row count at the end set it here
+        rss_start = current_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            seconds = time.perf_counter() - start
+            rss_end = current_rss_mb()
+            growth = None if rss_start is None or rss_end is None else round(rss_end - rss_start, 1)
+            with self.lock:
+                record = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'rows': 0,
+                                                       'rss_growth_mb': None})
+                record['seconds'] += seconds
+                record['calls'] += 1
+                record['rows'] += counts['rows']
+                record['rss_mb'] = rss_end  # After the last call
+                if growth is not None and (record['rss_growth_mb'] is None or growth > record['rss_growth_mb']):
+                    record['rss_growth_mb'] = growth  # Largest growth of the calls
+            self.log('stage', stage=name, seconds=round(seconds, 4), rows=counts['rows'],
+                     rss_start_mb=rss_start, rss_end_mb=rss_end)
+
+    # Add the lookup hits and misses of a carrier, per lookup kind and Rate Geography
+    def add_lookups(self, carrier_name, lookups):
+        with self.lock:
+            carrier = self.lookups.setdefault(carrier_name, {})
+            for kind, geographies in lookups.items():
+                for rate_type, counts in geographies.items():
+                    total = carrier.setdefault(kind, {}).setdefault(rate_type, {'hits': 0, 'misses': 0})
+                    total['hits'] += counts['hits']
+                    total['misses'] += counts['misses']
+
+    def add_reused(self, carrier_name):
+        with self.lock:
+            self.reused_results[carrier_name] = self.reused_results.get(carrier_name, 0) + 1
+
+    def finish(self):
+        self.seconds = time.time() - self.started
+        self.log('run', **self.to_dict())
+
+    def log(self, event, **fields):
+        METRICS_LOGGER.info(json.dumps({'event': event, 'run_id': self.run_id, **fields}, default=str))
+
+    def to_dict(self):
+        with self.lock:
+            stages = {name: {**record, 'seconds': round(record['seconds'], 4)} for name, record in self.stages.items()}
+            lookups = {}
+            for carrier_name, kinds in self.lookups.items():
+                for kind, geographies in kinds.items():
+                    for rate_type, counts in geographies.items():
+                        hit_rate = counts['hits'] / max(1, counts['hits'] + counts['misses'])
+                        lookups.setdefault(carrier_name, {}).setdefault(kind, {})[rate_type] = {
+                            **counts, 'hit_rate': round(hit_rate, 4)}
+        return {
+            'run_id': self.run_id,
+            'seconds': None if self.seconds is None else round(self.seconds, 4),
+            'rss_mb': current_rss_mb(),
+            'stages': stages,
+            'lookups': lookups,
+            'reused_results': dict(self.reused_results),
+            'profile_file': self.profile_file
+        }
+
+
+# Source and destination columns used to build the lane of each Rate Geography
+RATE_GEOGRAPHY_COLUMNS = {
+    'CITY-CITY': ('Source City', 'Destination City'),
+    'POSTAL-POSTAL': ('Source Postal', 'Destination Postal'),
+    'REGION-REGION': ('Source Region', 'Destination Region'),
+    'LOCATION-LOCATION': ('Source Location', 'Destination Location'),
+    'CITY-POSTAL': ('Source City', 'Destination Postal'),
+    'CITY-REGION': ('Source City', 'Destination Region'),
+    'CITY-LOCATION': ('Source City', 'Destination Location'),
+    'POSTAL-CITY': ('Source Postal', 'Destination City'),
+    'POSTAL-REGION': ('Source Postal', 'Destination Region'),
+    'POSTAL-LOCATION': ('Source Postal', 'Destination Location'),
+    'REGION-CITY': ('Source Region', 'Destination City'),
+    'REGION-POSTAL': ('Source Region', 'Destination Postal'),
+    'REGION-LOCATION': ('Source Region', 'Destination Location'),
+    'LOCATION-CITY': ('Source Location', 'Destination City'),
+    'LOCATION-POSTAL': ('Source Location', 'Destination Postal'),
+    'LOCATION-REGION': ('Source Location', 'Destination Region'),
+}
+
+# Rate Geographies evaluated by the simulation, in the order used to break ties
+SIMULATION_RATE_TYPES = ['CITY-CITY', 'POSTAL-POSTAL', 'REGION-REGION', 'LOCATION-LOCATION',
+                         'CITY-POSTAL', 'CITY-REGION', 'CITY-LOCATION', 'POSTAL-CITY', 'POSTAL-REGION',
+                         'POSTAL-LOCATION', 'REGION-CITY', 'REGION-POSTAL', 'REGION-LOCATION',
+                         'LOCATION-CITY', 'LOCATION-POSTAL']
+
+
+# Helper function to create the Adjusted Cost Type (Truck Type for EQUIPMENT, Cost Type otherwise)
+def adjusted_cost_type(df):
+    return df['Truck Type'].where(df['Cost Type'] == 'EQUIPMENT', df['Cost Type'])
+
+
+# Location columns of the historic data referenced by the Rate Geographies
+LOCATION_COLUMNS = sorted({column for columns in RATE_GEOGRAPHY_COLUMNS.values() for column in columns})
+
+# Text columns with few distinct values, held as categoricals so every value is stored once
+CATEGORICAL_COLUMNS = LOCATION_COLUMNS + ['Rate Geography', 'Adjusted Cost Type', 'Cost Type', 'Truck Type',
+                                          'Mode', 'Movement']
+
+
+# Helper function to add the Adjusted Cost Type to the historic data read from a file and intern its text columns
+def prepare_historic(historic_df):
+    historic_df['Adjusted Cost Type'] = adjusted_cost_type(historic_df)
+    return intern_categories(historic_df)
+
+
+# Helper function to intern the repetitive text columns of the historic data as categoricals
+def intern_categories(historic_df):
+    for column in CATEGORICAL_COLUMNS:
+        historic_df[column] = historic_df[column].astype('category')
+    return historic_df
+
+
+# Helper function to translate a column to codes of a dictionary of values, -1 for values not in it
+def dictionary_codes(column, dictionary):
+    column = column.astype('category')
+    codes = np.append(dictionary.get_indexer(column.cat.categories), -1)  # Code -1 picks the trailing -1
+    return codes[column.cat.codes.to_numpy()]
+
+
+# Index of a price list mapping (SOURCE, DESTINATION, Adjusted Cost Type) to the first matching Price
+# Lanes are matched as integer codes against the price list's own location and cost type dictionaries
+class LaneIndex:
+    def __init__(self, price_df):
+        price_table = price_df[['SOURCE', 'DESTINATION', 'Adjusted Cost Type', 'Price']].dropna(
+            subset=['SOURCE', 'DESTINATION', 'Adjusted Cost Type'])
+
+        # Sources and destinations share one location dictionary
+        location_codes, self.locations = pd.factorize(
+            pd.concat([price_table['SOURCE'], price_table['DESTINATION']], ignore_index=True))
+        cost_type_codes, self.cost_types = pd.factorize(price_table['Adjusted Cost Type'])
+        keys = self.lane_keys(location_codes[:len(price_table)], location_codes[len(price_table):], cost_type_codes)
+
+        # Keep the first price of every key, duplicates further down the price list are never used
+        duplicated = pd.Series(keys).duplicated(keep='first').to_numpy()
+        self.duplicates_collapsed = int(duplicated.sum())
+
+        self.keys = pd.Index(keys[~duplicated])
+        self.prices = price_table['Price'].to_numpy(dtype=float)[~duplicated]
+
+        # Prefix index for the fallback lookup: the location lengths in the price list, longest first, so only
+        # prefixes that can be in the location dictionary are tried
+        lengths = self.locations.astype(str).str.len().unique()
+        self.prefix_lengths = sorted((int(n) for n in lengths if n >= POSTAL_PREFIX_MIN_LENGTH), reverse=True)
+
+    def __len__(self):
+        return len(self.prices)
+
+    # Single integer key of every lane, -1 when a location or the cost type is not in the price list
+    def lane_keys(self, source_codes, destination_codes, cost_type_codes):
+        lanes = source_codes.astype(np.int64) * len(self.locations) + destination_codes
+        keys = lanes * len(self.cost_types) + cost_type_codes
+        return np.where((source_codes < 0) | (destination_codes < 0) | (cost_type_codes < 0), -1, keys)
+
+    # Codes of a historic location column in the location dictionary
+    def location_codes(self, column):
+        return dictionary_codes(column, self.locations)
+
+    # Codes of the prefixes of a historic location column in the location dictionary, one array per prefix length
+    # of prefix_lengths; -1 where the prefix is not a location or not shorter than the value itself, and None for
+    # a length no value is longer than or where no prefix is a location
+    def prefix_codes(self, column):
+        column = column.astype('category')
+        values = column.cat.categories.astype(str)
+        value_lengths = values.str.len()
+        codes = column.cat.codes.to_numpy()
+        prefix_codes = []
+        for length in self.prefix_lengths:
+            if not (value_lengths > length).any():
+                prefix_codes.append(None)
+                continue
+            value_codes = np.where(value_lengths > length, self.locations.get_indexer(values.str[:length]), -1)
+            if (value_codes < 0).all():
+                prefix_codes.append(None)
+                continue
+            prefix_codes.append(np.append(value_codes, -1)[codes])  # Code -1 of missing values picks the trailing -1
+        return prefix_codes
+
+    # Codes of a historic Adjusted Cost Type column in the cost type dictionary
+    def cost_type_codes(self, column):
+        return dictionary_codes(column, self.cost_types)
+
+    # Price of a single lane, None when the price list has no match
+    def get(self, source, destination, adjusted_cost_type):
+        price = self.get_prices(self.lane_keys(self.locations.get_indexer([source]),
+                                               self.locations.get_indexer([destination]),
+                                               self.cost_types.get_indexer([adjusted_cost_type])))[0]
+        return None if np.isnan(price) else price
+
+    # Prices of many lane keys at once, NaN when the price list has no match
+    def get_prices(self, keys):
+        positions = self.keys.get_indexer(keys)  # Key -1 is never in the index
+        return np.append(self.prices, np.nan)[positions]  # Position -1 picks the trailing NaN
+
+
+# Helper function to get the Rate Geography a postal lane falls back to, its postal sides replaced by regions
+def region_rate_type(rate_type):
+    return rate_type.replace('POSTAL', 'REGION')
+
+
+# Helper function to list the (source level, destination level) pairs tried by the fallback lookup of a lane,
+# most specific first; level 0 is the exact location and level i the i-th longest postal prefix
+def prefix_level_pairs(source_levels, destination_levels):
+    pairs = [(i, j) for i in range(source_levels) for j in range(destination_levels) if i or j]
+    return sorted(pairs, key=lambda pair: (pair[0] + pair[1], -pair[0]))
+
+
+# Function to replace the missing lanes of the Rate Geographies with a postal side by the lane of the longest
+# postal prefixes quoted in the price list, and then by the lane of the region
+def apply_fallback_keys(historic_df, lane_index, lane_keys, locations, cost_types):
+    prefixes = {}
+    fallback_keys = {}
+    for rate_type in lane_keys:
+        if 'POSTAL' not in rate_type:
+            continue
+        source, destination = RATE_GEOGRAPHY_COLUMNS[rate_type]
+        keys = lane_keys[rate_type].copy()
+        missing = np.flatnonzero(lane_index.keys.get_indexer(keys) < 0)
+
+        # Every postal side tries its prefixes, the other side stays exact
+        levels = []
+        for column in (source, destination):
+            if 'Postal' in column and column not in prefixes:
+                prefixes[column] = lane_index.prefix_codes(historic_df[column])
+            levels.append([locations[column]] + prefixes[column] if 'Postal' in column else [locations[column]])
+
+        for i, j in prefix_level_pairs(len(levels[0]), len(levels[1])):
+            if not len(missing):
+                break
+            if levels[0][i] is None or levels[1][j] is None:
+                continue  # No shipment has a location at this prefix length
+            source_codes, destination_codes = levels[0][i][missing], levels[1][j][missing]
+            if (source_codes < 0).all() or (destination_codes < 0).all():
+                continue  # No missing shipment has both sides at these levels
+            candidates = lane_index.lane_keys(source_codes, destination_codes, cost_types[missing])
+            found = lane_index.keys.get_indexer(candidates) >= 0
+            keys[missing[found]] = candidates[found]
+            missing = missing[~found]
+
+        # Lanes still missing fall back to the region
+        keys[missing] = lane_keys[region_rate_type(rate_type)][missing]
+        fallback_keys[rate_type] = keys
+    lane_keys.update(fallback_keys)
+
+
+# Helper function to build the lane keys of every shipment against one price list, for all Rate Geographies
+# or only the given ones (postal ones also get their region in fallback mode)
+def build_lane_keys(historic_df, lane_index, lookup_mode='exact', rate_types=None):
+    rate_types = list(RATE_GEOGRAPHY_COLUMNS) if rate_types is None else list(rate_types)
+    if lookup_mode == 'fallback':
+        rate_types = list(dict.fromkeys(rate_types + [region_rate_type(rate_type) for rate_type in rate_types
+                                                      if 'POSTAL' in rate_type]))
+
+    # Translate each location column to the price list's codes once, every Rate Geography reuses them
+    columns = {column for rate_type in rate_types for column in RATE_GEOGRAPHY_COLUMNS[rate_type]}
+    locations = {column: lane_index.location_codes(historic_df[column]) for column in LOCATION_COLUMNS
+                 if column in columns}
+    cost_types = lane_index.cost_type_codes(historic_df['Adjusted Cost Type'])
+
+    lane_keys = {rate_type: lane_index.lane_keys(locations[RATE_GEOGRAPHY_COLUMNS[rate_type][0]],
+                                                 locations[RATE_GEOGRAPHY_COLUMNS[rate_type][1]], cost_types)
+                 for rate_type in rate_types}
+    if lookup_mode == 'fallback':
+        apply_fallback_keys(historic_df, lane_index, lane_keys, locations, cost_types)
+
+    # Lane of the shipment's own Rate Geography, no match for unsupported or unexpected ones
+    original_keys = np.full(len(historic_df), -1, dtype=np.int64)
+    rate_geography = historic_df['Rate Geography'].astype('category')
+    geography_codes = rate_geography.cat.codes.to_numpy()
+    for code, rate_type in enumerate(rate_geography.cat.categories):
+        if rate_type in lane_keys:
+            mask = geography_codes == code
+            original_keys[mask] = lane_keys[rate_type][mask]
+
+    return lane_keys, original_keys
+
+
+# Helper function to hash the content of an uploaded file, given by its path or its stream
+def file_digest(source):
+    digest = hashlib.sha256()
+    with open(source, 'rb') if isinstance(source, str) else contextlib.nullcontext(source) as f:
+        f.seek(0)
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+        f.seek(0)
+    return digest.hexdigest()
+
+
+# Function to pickle an object to a file, written to a temporary file first so concurrent runs never read a partial
+# file; a file that cannot be written (disk full, permissions) is logged and skipped, returns whether it was written
+def atomic_pickle(path, obj):
+    return atomic_write(path, functools.partial(pickle.dump, obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+# Function to write a file through a temporary file, write is called with the binary file object
+def atomic_write(path, write):
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            write(f)
+        os.replace(temp_path, path)
+        return True
+    except OSError:
+        app.logger.warning(f'{path} could not be written', exc_info=True)
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        return False
+
+
+# Function to load a price list as a LaneIndex, from the cache when a file with the same content was indexed before
+def load_price_list(path, digest=None, filename=None):
+    cache_path = os.path.join(PRICE_CACHE_FOLDER, f'{digest or file_digest(path)}-v{PRICE_CACHE_VERSION}.pkl')
+    try:
+        with open(cache_path, 'rb') as f:
+            lane_index = pickle.load(f)
+        os.utime(cache_path)  # Mark the entry as recently used
+        return lane_index
+    except FileNotFoundError:
+        pass
+    except Exception:
+        app.logger.warning(f'Unreadable price list cache entry {cache_path}, rebuilding it', exc_info=True)
+
+    price_df = read_price_list(path, filename)
+    price_df['Adjusted Cost Type'] = adjusted_cost_type(price_df)
+    lane_index = LaneIndex(price_df)
+
+    if atomic_pickle(cache_path, lane_index):
+        evict_cache(PRICE_CACHE_FOLDER, app.config['PRICE_CACHE_MAX_BYTES'])
+    return lane_index
+
+
+# Function to remove the least recently used entries of a cache folder above its size limit
+def evict_cache(folder, max_bytes):
+    entries = []
+    for entry in os.scandir(folder):
+        if entry.name.endswith('.pkl'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    cache_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if cache_size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+
+
+# Helper function to get the quantity every shipment's price is multiplied by:
+# KM is charged per Traveled Distance, KG per Weight, anything else is a flat price
+def cost_multiplier(historic_df):
+    cost_type = historic_df['Cost Type'].to_numpy()
+    return np.where(cost_type == 'KM', historic_df['Traveled Distance'].to_numpy(dtype=float),
+                    np.where(cost_type == 'KG', historic_df['Weight'].to_numpy(dtype=float), 1.0))
+
+
+# Helper function to calculate the cost and return the price used for the calculation, for all shipments at once
+# (the multiplier of every shipment can be passed in when the same shipments are priced for many lanes)
+def calculate_costs_and_prices(historic_df, lane_index, lane_keys, multiplier=None):
+    price = lane_index.get_prices(lane_keys)
+    if multiplier is None:
+        multiplier = cost_multiplier(historic_df)
+
+    cost = pd.Series(price * multiplier, index=historic_df.index)
+    return cost, pd.Series(price, index=historic_df.index)
+
+
+# Helper function to count the prices found and missing, per Rate Geography when one is given
+def lookup_counts(prices, rate_geography=None):
+    found = prices.notna()
+    if rate_geography is None:
+        return {'hits': int(found.sum()), 'misses': int((~found).sum())}
+    counts = found.groupby(rate_geography, observed=True).agg(['sum', 'count'])
+    return {rate_type: {'hits': int(hits), 'misses': int(total - hits)}
+            for rate_type, (hits, total) in counts.iterrows()}
+
+
+# Running minimum simulation cost of every shipment with its price and Rate Geography, updated one simulated
+# Rate Geography at a time so only the best cost, price and geography arrays are held
+class MinimumSimulation:
+    def __init__(self, rows):
+        self.cost = np.full(rows, np.nan)
+        self.price = np.full(rows, np.nan)
+        self.codes = np.full(rows, -1, dtype=np.int8)
+
+    # Take the cost and price of the Rate Geography with the given position where they beat the best so far
+    def add(self, code, cost, price):
+        cost = np.asarray(cost, dtype=float)
+        # Missing costs never win; the strict comparison keeps the first minimum so ties resolve in rate type order
+        better = (cost < self.cost) | (np.isnan(self.cost) & ~np.isnan(cost))
+        self.cost[better] = cost[better]
+        self.price[better] = np.asarray(price, dtype=float)[better]
+        self.codes[better] = code
+
+    # Minimum costs, prices and Rate Geographies, NaN and None where no Rate Geography has a price
+    def result(self, rate_types):
+        return self.cost, self.price, np.append(np.array(rate_types, dtype=object), None)[self.codes]
+
+
+# Columns of the historic data a carrier recalculation needs
+CARRIER_INPUT_COLUMNS = LOCATION_COLUMNS + [
+    'Rate Geography', 'Adjusted Cost Type', 'Cost Type', 'Traveled Distance', 'Weight', 'Total Cost'
+]
+
+
+# Scenarios of the carrier results: the shipment's own Rate Geography and the cheapest simulated one
+RESULT_SCENARIOS = ['Recalculated', 'Minimum_Simulation']
+
+# Columns of the long carrier results, one row per shipment, carrier and scenario with a price
+RESULT_COLUMNS = ['Shipment', 'Carrier', 'Scenario', 'Rate Geography', 'Cost', 'Price']
+
+
+# Helper function to build the long result rows of one scenario, shipments without a price are left out
+def result_rows(scenario, shipments, rate_geography, cost, price):
+    found = ~np.isnan(np.asarray(price, dtype=float))
+    return pd.DataFrame({
+        'Shipment': np.asarray(shipments)[found],
+        'Scenario': pd.Categorical.from_codes(np.full(found.sum(), RESULT_SCENARIOS.index(scenario)), RESULT_SCENARIOS),
+        'Rate Geography': pd.Categorical(np.asarray(rate_geography, dtype=object)[found],
+                                         categories=list(RATE_GEOGRAPHY_COLUMNS)),
+        'Cost': np.asarray(cost, dtype=float)[found],
+        'Price': np.asarray(price, dtype=float)[found],
+    })
+
+
+# Function to recalculate one carrier's indexed price list against the historic data, for the given scenarios only
+# Returns its long result rows (without the Carrier column) and the lookup hits and misses per Rate Geography
+def calculate_carrier_results(historic_df, lane_index, lookup_mode='exact', scenarios=RESULT_SCENARIOS):
+    simulate = 'Minimum_Simulation' in scenarios
+    # Without the simulation only the Rate Geographies the shipments use need lane keys
+    rate_types = None if simulate else [rate_type for rate_type in historic_df['Rate Geography'].dropna().unique()
+                                        if rate_type in RATE_GEOGRAPHY_COLUMNS]
+    lane_keys, original_keys = build_lane_keys(historic_df, lane_index, lookup_mode, rate_types)
+
+    multiplier = cost_multiplier(historic_df)
+    results = []
+    lookups = {'recalculation': {}, 'simulation': {}}
+
+    # Part 1: Calculate Recalculated Cost and Price Using the Original Rate Geography
+    if 'Recalculated' in scenarios:
+        recalculated_cost, recalculated_price = calculate_costs_and_prices(historic_df, lane_index, original_keys,
+                                                                           multiplier)
+        lookups['recalculation'] = lookup_counts(recalculated_price, historic_df['Rate Geography'])
+        results.append(result_rows('Recalculated', historic_df.index, historic_df['Rate Geography'],
+                                   recalculated_cost, recalculated_price))
+
+    # Part 2: Simulation - Keep the cheapest of the remaining 15 geography types while calculating them
+    if simulate:
+        minimum = MinimumSimulation(len(historic_df))
+        for code, rate_type in enumerate(SIMULATION_RATE_TYPES):
+            simulation_cost, simulation_price = calculate_costs_and_prices(historic_df, lane_index,
+                                                                           lane_keys[rate_type], multiplier)
+            minimum.add(code, simulation_cost, simulation_price)
+            lookups['simulation'][rate_type] = lookup_counts(simulation_price)
+        minimum_cost, minimum_price, minimum_geography = minimum.result(SIMULATION_RATE_TYPES)
+        results.append(result_rows('Minimum_Simulation', historic_df.index, minimum_geography, minimum_cost,
+                                   minimum_price))
+
+    return pd.concat(results, ignore_index=True), lookups
+
+
+# Lane indexes of the run, shipped once to every worker process by the pool initializer
+WORKER_LANE_INDEXES = []
+
+
+def init_carrier_worker(lane_indexes):
+    global WORKER_LANE_INDEXES
+    WORKER_LANE_INDEXES = lane_indexes
+
+
+# Function run in the process pool: recalculate one carrier from the shipped columns
+def carrier_worker(position, historic_df, lookup_mode, scenarios):
+    return calculate_carrier_results(historic_df, WORKER_LANE_INDEXES[position], lookup_mode, scenarios)
+
+
+# Function to create the process pool recalculating the carriers of a run, a no-op context with a single worker
+def carrier_pool(lane_indexes, workers):
+    workers = min(workers, len(lane_indexes))
+    if workers <= 1:
+        return contextlib.nullcontext()
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=init_carrier_worker, initargs=(lane_indexes,))
+
+
+# Function to create the process pool of the shard workers, which get the lane indexes of the run once
+def shard_pool(lane_indexes, workers):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=init_carrier_worker, initargs=(lane_indexes,))
+
+
+# Helper function to build the result cache keys of the carriers, part tells apart the chunks of a streamed file
+# and the computed scenarios are part of the key
+def result_cache_keys(historic_digest, price_digests, lookup_mode, scenarios=RESULT_SCENARIOS, part='all'):
+    scenario_flags = ''.join(str(int(scenario in scenarios)) for scenario in RESULT_SCENARIOS)
+    return [f'{historic_digest}-{part}-{price_digest}-{lookup_mode}-{scenario_flags}-v{RESULT_CACHE_VERSION}'
+            for price_digest in price_digests]
+
 
+# Function to load the long results and lookups of a carrier from the result cache, None when not cached
+def load_carrier_results(cache_key):
+    cache_path = os.path.join(RESULT_CACHE_FOLDER, f'{cache_key}.pkl')
+    try:
+        with open(cache_path, 'rb') as f:
+            carrier_results = pickle.load(f)
+        os.utime(cache_path)  # Mark the entry as recently used
+        return carrier_results
+    except FileNotFoundError:
+        return None
+    except Exception:
+        app.logger.warning(f'Unreadable result cache entry {cache_path}, recalculating it', exc_info=True)
+        return None
+
+
+# Helper function to count the carriers without cached results, no pool is started for a single one
+def uncached_count(cache_keys):
+    return sum(not os.path.exists(os.path.join(RESULT_CACHE_FOLDER, f'{key}.pkl')) for key in cache_keys)
+
+
+# Function to store the long results and lookups of a carrier in the result cache
+def store_carrier_results(cache_key, carrier_results):
+    if atomic_pickle(os.path.join(RESULT_CACHE_FOLDER, f'{cache_key}.pkl'), carrier_results):
+        evict_cache(RESULT_CACHE_FOLDER, app.config['RESULT_CACHE_MAX_BYTES'])
+
+
+# Function to recalculate all carriers, in the process pool when one is given
+# Carriers whose results are found under their cache key are reused, the others are recalculated and stored
+# Returns the carrier names in price list order and the long results of all carriers
+def calculate_all_carriers(historic_df, lane_indexes, pool=None, progress=no_progress, rows_offset=0, metrics=None,
+                           cache_keys=None, lookup_mode='exact', scenarios=RESULT_SCENARIOS):
+    metrics = metrics or RunMetrics()
+    carrier_names = [f"carrier{i + 1}" for i in range(len(lane_indexes))]
+
+    cached = [load_carrier_results(key) for key in cache_keys] if cache_keys else [None] * len(lane_indexes)
+    changed = [position for position, carrier_results in enumerate(cached) if carrier_results is None]
+
+    if pool is not None and changed:
+        # Each worker only receives the historic columns it needs
+        carrier_input = historic_df[CARRIER_INPUT_COLUMNS]
+        computed = pool.map(carrier_worker, changed, [carrier_input] * len(changed), [lookup_mode] * len(changed),
+                            [scenarios] * len(changed))
+    else:
+        computed = (calculate_carrier_results(historic_df, lane_indexes[position], lookup_mode, scenarios)
+                    for position in changed)
+
+    results = []
+    for position, carrier_name in enumerate(carrier_names):
+        if cached[position] is None:
+            carrier_results = next(computed)
+            if cache_keys:
+                store_carrier_results(cache_keys[position], carrier_results)
+        else:
+            carrier_results = cached[position]
+            metrics.add_reused(carrier_name)
+        result, lookups = carrier_results
+        results.append(result)
+        metrics.add_lookups(carrier_name, lookups)
+        progress(stage='recalculating', carrier=carrier_name, rows_done=rows_offset + len(historic_df))
+
+    # The carrier of every row is stored as a code into the carrier names
+    carrier_codes = np.repeat(np.arange(len(results)), [len(result) for result in results])
+    results = pd.concat(results, ignore_index=True) if results else pd.DataFrame(
+        columns=[column for column in RESULT_COLUMNS if column != 'Carrier'])
+    results.insert(1, 'Carrier', pd.Categorical.from_codes(carrier_codes, carrier_names))
+    return carrier_names, results
+
+
+# Function to split the long results per carrier and scenario, indexed by shipment, for the wide export
+def split_results(results):
+    return {key: group.set_index('Shipment')[['Cost', 'Price', 'Rate Geography']]
+            for key, group in results.groupby(['Carrier', 'Scenario'], observed=True)}
+
+
+# Columns of a carrier and scenario without any priced shipment
+NO_RESULTS = pd.DataFrame({'Cost': pd.Series(dtype=float), 'Price': pd.Series(dtype=float),
+                           'Rate Geography': pd.Series(dtype=object)})
+
+
+# Function to produce the wide export view of some shipments: the historic columns followed by the
+# result columns of every carrier for the computed scenarios, with the differences to the historic cost
+def export_frame(historic_df, result_groups, carrier_names, scenarios=RESULT_SCENARIOS):
+    columns = {}
+    for carrier_name in carrier_names:
+        if 'Recalculated' in scenarios:
+            recalculated = result_groups.get((carrier_name, 'Recalculated'), NO_RESULTS).reindex(historic_df.index)
+
+            # Difference and percentage difference between the recalculated cost and the historic cost
+            difference = recalculated['Cost'] - historic_df['Total Cost']
+            columns[f'{carrier_name}_Recalculated_Cost'] = recalculated['Cost']
+            columns[f'{carrier_name}_Recalculated_Price'] = recalculated['Price']
+            columns[f'{carrier_name}_Difference'] = difference
+            columns[f'{carrier_name}_Recalculated_Percentage'] = (difference / historic_df['Total Cost']) * 100
+
+        if 'Minimum_Simulation' in scenarios:
+            simulation = result_groups.get((carrier_name, 'Minimum_Simulation'), NO_RESULTS).reindex(historic_df.index)
+
+            # Difference and percentage difference between the minimum simulation cost and the historic cost
+            simulation_difference = simulation['Cost'] - historic_df['Total Cost']
+            columns[f'{carrier_name}_Minimum_Simulation_Cost'] = simulation['Cost']
+            columns[f'{carrier_name}_Simulation_Difference'] = simulation_difference
+            columns[f'{carrier_name}_Simulation_Percentage'] = (simulation_difference / historic_df['Total Cost']) * 100
+
+            # Add the corresponding minimum price and Rate Geography
+            columns[f'{carrier_name}_Minimum_Simulation_Price'] = simulation['Price']
+            columns[f'{carrier_name}_Minimum_Rate_Geography'] = simulation['Rate Geography']
+
+    return pd.concat([historic_df, pd.DataFrame(columns, index=historic_df.index)], axis=1)
+
+
+# Scenario summary sheets: (sheet name, grouping key or None, summed carrier result scenario, cost header)
+SCENARIO_SHEETS = [
+    ('Scenario1-Best_Carrier', None, 'Recalculated', 'Total Recalculated Cost'),
+    ('Scenario2-BC_Simulation', None, 'Minimum_Simulation', 'Minimum Simulation Cost'),
+    ('Scenario3-Best_Mode', 'Mode', 'Recalculated', 'Total Recalculated Cost'),
+    ('Scenario4-BM_Simulation', 'Mode', 'Minimum_Simulation', 'Minimum Simulation Cost'),
+    ('Scenario5-Best_Movement', 'Movement', 'Recalculated', 'Total Recalculated Cost'),
+    ('Scenario6-BMV_Simulation', 'Movement', 'Minimum_Simulation', 'Minimum Simulation Cost'),
+]
+
+# Dimensions of the results cube every run saves for the cube query route
+CUBE_DIMENSIONS = ('Mode', 'Movement', 'Month', 'Rate Geography')
+
+# Breakdowns used by the scenario summaries (None is the overall total) and the results cube
+SUMMARY_GROUPINGS = list(dict.fromkeys(group_by for _, group_by, _, _ in SCENARIO_SHEETS)) + [CUBE_DIMENSIONS]
+
+# Work of a run derived from the requested scenario sheets: the sheets, the carrier result scenarios they sum
+# and the breakdowns they need (the results cube is always saved)
+RunPlan = collections.namedtuple('RunPlan', ['sheets', 'scenarios', 'groupings'])
+
+
+# Function to plan a run for the requested scenario sheet names, all of them when none are given
+def plan_run(sheet_names=None):
+    sheets = [sheet for sheet in SCENARIO_SHEETS if not sheet_names or sheet[0] in sheet_names]
+    scenarios = [scenario for scenario in RESULT_SCENARIOS if any(sheet[2] == scenario for sheet in sheets)]
+    groupings = [group_by for group_by in SUMMARY_GROUPINGS
+                 if group_by == CUBE_DIMENSIONS or any(sheet[1] == group_by for sheet in sheets)]
+    return RunPlan(sheets, scenarios, groupings)
+
+
+FULL_PLAN = plan_run()
+SCENARIO_SHEET_NAMES = [sheet_name for sheet_name, _, _, _ in SCENARIO_SHEETS]
+
+# Summed costs of a breakdown: the historic cost per group, and per group the cost of every carrier and
+# scenario in columns (Carrier, Scenario)
+ScenarioTotals = collections.namedtuple('ScenarioTotals', ['historic', 'carriers'])
+
+
+# Helper function to get the group of every shipment for a summary breakdown
+# (any historic column such as Mode, Movement, Carrier or Truck Type, Month of the Shipment Date, None for
+# the overall total, or a tuple of them for a frame of groups)
+def summary_groups(df, group_by):
+    if group_by is None:
+        return pd.Series(0, index=df.index)
+    if isinstance(group_by, tuple):
+        return pd.concat([summary_groups(df, column) for column in group_by], axis=1)
+    if group_by == 'Month':
+        return pd.to_datetime(df['Shipment Date'], errors='coerce').dt.strftime('%Y-%m').rename('Month')
+    return df[group_by]
+
+
+# Function to sum the historic cost and the cost of every carrier and scenario, overall or per group
+def aggregate_totals(historic_df, results, carrier_names, group_by=None, scenarios=RESULT_SCENARIOS):
+    groups = summary_groups(historic_df, group_by)
+    # A frame of groups is grouped by all its columns
+    keys = [groups[column] for column in groups] if isinstance(groups, pd.DataFrame) else [groups]
+    if group_by is None:
+        # The overall total exists even without shipments
+        historic = pd.Series([historic_df['Total Cost'].sum()])
+    else:
+        # Groups keep their order of first appearance, shipments without a group are summed together
+        historic = historic_df['Total Cost'].groupby(keys if len(keys) > 1 else groups,
+                                                     sort=False, dropna=False, observed=True).sum()
+
+    # Group of every result row, looked up through its shipment
+    positions = historic_df.index.get_indexer(results['Shipment'])
+    result_keys = [key.take(positions).set_axis(results.index) for key in keys]
+    costs = results['Cost'].groupby(result_keys + [results['Carrier'], results['Scenario']],
+                                    sort=False, dropna=False, observed=True).sum()
+
+    columns = pd.MultiIndex.from_product([carrier_names, scenarios], names=['Carrier', 'Scenario'])
+    carriers = costs.unstack(['Carrier', 'Scenario']).reindex(index=historic.index, columns=columns).fillna(0.0)
+    return ScenarioTotals(historic, carriers)
+
+
+# Function to merge the totals of two parts of the historic data, groups keep their order of first appearance
+def merge_totals(totals, partial_totals):
+    if totals is None:
+        return partial_totals
+    levels = list(range(totals.historic.index.nlevels)) if totals.historic.index.nlevels > 1 else 0
+    historic = pd.concat([totals.historic, partial_totals.historic]).groupby(
+        level=levels, sort=False, dropna=False, observed=True).sum()
+    carriers = pd.concat([totals.carriers, partial_totals.carriers]).groupby(
+        level=levels, sort=False, dropna=False, observed=True).sum()
+    return ScenarioTotals(historic, carriers.reindex(historic.index))
+
+
+# Function to rank the carriers of every group by their summed cost of a scenario (ascending order)
+def rank_carriers(totals, scenario):
+    carrier_costs = totals.carriers.xs(scenario, axis=1, level='Scenario')
+
+    ranking = []
+    for group, total_historic_cost, row in zip(totals.historic.index, totals.historic.to_numpy(),
+                                               carrier_costs.to_numpy()):
         carrier_data = []
-        for col_name in carrier_columns:
-            carrier_name = col_name.replace('_Recalculated_Cost', '')
-            total_recalculated_cost = movement_df[col_name].sum()
-            total_difference = total_recalculated_cost - total_historic_cost
+        for carrier_name, total_cost in zip(carrier_costs.columns, row):
+            # Difference and % Difference (Total Difference / Total Historic Cost) against the historic cost
+            total_difference = total_cost - total_historic_cost
             percent_difference = (total_difference / total_historic_cost) * 100
 
             carrier_data.append({
                 'carrier_name': carrier_name,
-                'total_recalculated_cost': total_recalculated_cost,
+                'total_cost': total_cost,
                 'total_difference': total_difference,
                 'percent_difference': percent_difference
             })
 
-        carrier_data = sorted(carrier_data, key=lambda x: x['total_recalculated_cost'])
+        carrier_data = sorted(carrier_data, key=lambda x: x['total_cost'])
+        ranking.append((group, total_historic_cost, carrier_data))
+    return ranking
 
-        movement_filled = False
-        cost_filled = False
-        for idx, carrier in enumerate(carrier_data):
-            if not movement_filled:
-                ws[f'B{row_idx}'] = movement
-                movement_filled = True
-            if not cost_filled:
-                ws[f'C{row_idx}'] = total_historic_cost
-                cost_filled = True
-
-            ws[f'D{row_idx}'] = carrier['carrier_name']
-            ws[f'E{row_idx}'] = carrier['total_recalculated_cost']
-            ws[f'F{row_idx}'] = carrier['total_difference']
-            ws[f'G{row_idx}'] = idx + 1
-            ws[f'H{row_idx}'] = carrier['percent_difference']
-            row_idx += 1
-
-    wb.save(output_file)
-
-
-# Function to create a summary for "Scenario6-BMV_Simulation" with a breakdown by Movement using Minimum Simulation Cost
-def create_bmv_simulation_summary(output_file, df):
-    wb = load_workbook(output_file)
-    main_sheet = wb.active
-
-    if "Scenario6-BMV_Simulation" in wb.sheetnames:
-        del wb["Scenario6-BMV_Simulation"]
-    ws = wb.create_sheet("Scenario6-BMV_Simulation")
-
-    ws['B1'] = 'Movement'
-    ws['C1'] = 'Total Historic Cost'
-    ws['D1'] = 'Carrier Name'
-    ws['E1'] = 'Minimum Simulation Cost'
-    ws['F1'] = 'Total Difference'
-    ws['G1'] = 'Rank'
-    ws['H1'] = '% Difference'
-
-    unique_movements = df['Movement'].unique()
-    row_idx = 2
-
-    for movement in unique_movements:
-        movement_df = df[df['Movement'] == movement]
-        total_historic_cost = movement_df['Total Cost'].sum()
-        carrier_columns = [col for col in movement_df.columns if '_Minimum_Simulation_Cost' in col]
 
-        carrier_data = []
-        for col_name in carrier_columns:
-            carrier_name = col_name.replace('_Minimum_Simulation_Cost', '')
-            total_simulation_cost = movement_df[col_name].sum()
-            total_difference = total_simulation_cost - total_historic_cost
-            percent_difference = (total_difference / total_historic_cost) * 100
+# Function to create a scenario summary sheet from the summed totals, overall or with a breakdown per group
+def create_scenario_summary(wb, sheet_name, totals, group_by, scenario, cost_header):
+    ws = wb.create_sheet(sheet_name)
 
-            carrier_data.append({
-                'carrier_name': carrier_name,
-                'total_simulation_cost': total_simulation_cost,
-                'total_difference': total_difference,
-                'percent_difference': percent_difference
-            })
+    if group_by is None:
+        ws.append([None, 'Total Historic Cost', 'Carrier Name', cost_header, 'Total Difference', 'Rank', '% Difference'])
+    else:
+        ws.append([None, group_by, 'Total Historic Cost', 'Carrier Name', cost_header, 'Total Difference', 'Rank',
+                   '% Difference'])
 
-        carrier_data = sorted(carrier_data, key=lambda x: x['total_simulation_cost'])
+    for group, total_historic_cost, carrier_data in rank_carriers(totals, scenario):
+        # Only write the group and the total historic cost on the first row of each group
+        group_cells = [total_historic_cost] if group_by is None else [None if pd.isna(group) else group, total_historic_cost]
+        if not carrier_data:
+            ws.append([None] + group_cells)
 
-        movement_filled = False
-        cost_filled = False
         for idx, carrier in enumerate(carrier_data):
-            if not movement_filled:
-                ws[f'B{row_idx}'] = movement
-                movement_filled = True
-            if not cost_filled:
-                ws[f'C{row_idx}'] = total_historic_cost
-                cost_filled = True
-
-            ws[f'D{row_idx}'] = carrier['carrier_name']
-            ws[f'E{row_idx}'] = carrier['total_simulation_cost']
-            ws[f'F{row_idx}'] = carrier['total_difference']
-            ws[f'G{row_idx}'] = idx + 1
-            ws[f'H{row_idx}'] = carrier['percent_difference']
-            row_idx += 1
-
-    wb.save(output_file)
-
-
-
-# Processing Route - Recalculation and Simulation
+            ws.append([None]
+                      + (group_cells if idx == 0 else [None] * len(group_cells))
+                      + [carrier['carrier_name'],  # Carrier Name
+                         carrier['total_cost'],  # Total Recalculated Cost or Minimum Simulation Cost
+                         carrier['total_difference'],  # Total Difference
+                         idx + 1,  # Rank
+                         carrier['percent_difference']])  # % Difference
+
+
+# Helper function to convert a column to cell values the way to_excel does (blank when missing, text for infinity)
+def excel_values(column):
+    values = column.astype(object).where(column.notna(), None)
+    if column.dtype.kind == 'f':
+        numbers = column.to_numpy()
+        values[np.isposinf(numbers)] = 'inf'
+        values[np.isneginf(numbers)] = '-inf'
+    return values.tolist()
+
+
+# Function to append the rows of a DataFrame to a write-only sheet
+def append_rows(ws, df):
+    # Convert the rows chunk by chunk so only one chunk of cell values is held in memory
+    for start in range(0, len(df), WRITE_CHUNK_SIZE):
+        chunk = df.iloc[start:start + WRITE_CHUNK_SIZE]
+        columns = [excel_values(chunk.iloc[:, j]) for j in range(chunk.shape[1])]
+        for row in zip(*columns):
+            ws.append(row)
+
+
+# Writer of the results to the main sheet of a write-only workbook
+# Rows beyond the Excel row limit continue on "Sheet1 (2)", "Sheet1 (3)", ... each with its own header row
+class ExcelResultsWriter:
+    def __init__(self, wb, title='Sheet1'):
+        self.wb = wb
+        self.title = title
+        self.columns = None
+        self.sheets = 0
+        self.ws = None
+        self.rows = 0
+
+    def write(self, df):
+        if self.columns is None:
+            self.columns = list(df.columns)
+            self.add_sheet()
+
+        start = 0
+        while start < len(df):
+            if self.rows == EXCEL_MAX_ROWS:
+                self.add_sheet()
+            part = df.iloc[start:start + EXCEL_MAX_ROWS - self.rows]
+            append_rows(self.ws, part)
+            self.rows += len(part)
+            start += len(part)
+
+    def add_sheet(self):
+        self.sheets += 1
+        self.ws = self.wb.create_sheet(self.title if self.sheets == 1 else f'{self.title} ({self.sheets})')
+        self.ws.append(self.columns)
+        self.rows = 1
+
+    def close(self):
+        pass  # Saved with the workbook
+
+
+# Writer of the results to a CSV file, gzip compressed when asked
+class CsvResultsWriter:
+    def __init__(self, path, compress=False):
+        self.file = gzip.open(path, 'wt', newline='') if compress else open(path, 'w', newline='')
+        self.header = True
+
+    def write(self, df):
+        df.to_csv(self.file, header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        self.file.close()
+
+
+# Writer of the results to a Parquet file, one row group per written chunk
+class ParquetResultsWriter:
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # Categories differ from chunk to chunk, so categorical columns are written as plain text
+        df = df.astype({column: object for column, dtype in df.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)})
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            # Columns without any value in the first chunk are typed as text
+            schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                for field in table.schema])
+            self.writer = pq.ParquetWriter(self.path, schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+# Function to open the writer of the results file in an output format, xlsx results go to the main sheet of wb
+def open_results_writer(output_file, output_format, wb):
+    if output_format == 'xlsx':
+        return ExcelResultsWriter(wb)
+    if output_format == 'parquet':
+        return ParquetResultsWriter(output_file)
+    return CsvResultsWriter(output_file, compress=output_format == 'csv.gz')
+
+
+# Function to write the wide view of the historic data and the carrier results, with its header row
+def write_results(writer, historic_df, results, carrier_names, progress=no_progress, scenarios=RESULT_SCENARIOS):
+    result_groups = split_results(results)
+    writer.write(export_frame(historic_df.iloc[:0], result_groups, carrier_names, scenarios))  # Header even without rows
+
+    # The wide columns only exist for the chunk of rows being written
+    for start in range(0, len(historic_df), WRITE_CHUNK_SIZE):
+        chunk = historic_df.iloc[start:start + WRITE_CHUNK_SIZE]
+        writer.write(export_frame(chunk, result_groups, carrier_names, scenarios))
+        progress(stage='writing', carrier=None, rows_done=min(start + WRITE_CHUNK_SIZE, len(historic_df)),
+                 rows_total=len(historic_df))
+
+
+# Function to add the planned scenario summaries to the output workbook from the totals of each breakdown
+def write_scenario_sheets(wb, totals, metrics=None, plan=FULL_PLAN):
+    metrics = metrics or RunMetrics()
+    for sheet_name, group_by, scenario, cost_header in plan.sheets:
+        with metrics.stage(sheet_name, rows=len(totals[group_by])):
+            create_scenario_summary(wb, sheet_name, totals[group_by], group_by, scenario, cost_header)
+
+
+# Function to save the results cube of a run next to its results file, read back by the cube query route
+def write_cube(output_file, totals, metrics=None):
+    metrics = metrics or RunMetrics()
+    with metrics.stage('write_cube', rows=len(totals[CUBE_DIMENSIONS])):
+        atomic_pickle(os.path.join(os.path.dirname(output_file), CUBE_NAME + '.pkl'), totals[CUBE_DIMENSIONS])
+
+
+# Function to write the results file and the planned scenario summaries in a single pass
+# The summaries go to the results workbook for xlsx, to the separate summary workbook for the other formats
+def write_output(output_file, summary_file, output_format, historic_df, results, carrier_names, progress=no_progress,
+                 metrics=None, plan=FULL_PLAN):
+    metrics = metrics or RunMetrics()
+
+    # A write-only workbook streams each sheet to disk as it is filled
+    wb = Workbook(write_only=True)
+    with metrics.stage('write_results', rows=len(historic_df)):
+        writer = open_results_writer(output_file, output_format, wb)
+        write_results(writer, historic_df, results, carrier_names, progress=progress, scenarios=plan.scenarios)
+        writer.close()
+
+    # Sum the costs once per breakdown, the scenarios sharing a breakdown reuse the same totals
+    with metrics.stage('summary_totals', rows=len(results)):
+        totals = {group_by: aggregate_totals(historic_df, results, carrier_names, group_by, plan.scenarios)
+                  for group_by in plan.groupings}
+    write_scenario_sheets(wb, totals, metrics, plan)
+    write_cube(output_file, totals, metrics)
+
+    with metrics.stage('save_workbook'):
+        wb.save(summary_file)
+
+
+# Function to load the indexed price lists of a run, given by their paths or uploaded streams and their file names,
+# with their content hashes and report the duplicate keys they collapsed
+def load_price_lists(price_list_sources, price_list_files):
+    # Load from the cache when the same file was uploaded before
+    price_digests = [file_digest(source) for source in price_list_sources]
+    lane_indexes = [load_price_list(source, digest, price_file)
+                    for source, price_file, digest in zip(price_list_sources, price_list_files, price_digests)]
+
+    duplicates_collapsed = {}
+    for i, lane_index in enumerate(lane_indexes):
+        carrier_name = f"carrier{i + 1}"
+        if lane_index.duplicates_collapsed:
+            app.logger.warning(f'{carrier_name}: {lane_index.duplicates_collapsed} duplicate Lane/Adjusted Cost Type '
+                               f'rows in {price_list_files[i]} ignored, the first price is used')
+        duplicates_collapsed[carrier_name] = lane_index.duplicates_collapsed
+    return lane_indexes, price_digests, duplicates_collapsed
+
+
+# Helper function to get the results and summary files of a run in its workspace, with the names they are
+# downloaded by (the summary file is None when the summary sheets are in the results workbook)
+def output_paths(workspace_id, output_format):
+    output_file = os.path.join(workspace_path(workspace_id), OUTPUT_NAME + OUTPUT_FORMATS[output_format])
+    summary_file = output_file if output_format == 'xlsx' else os.path.join(workspace_path(workspace_id),
+                                                                          SUMMARY_NAME + '.xlsx')
+    result = {'output_file': f'{workspace_id}/{os.path.basename(output_file)}',
+              'summary_file': None if summary_file == output_file else f'{workspace_id}/{os.path.basename(summary_file)}'}
+    return output_file, summary_file, result
+
+
+# Function running the recalculation and simulation of a historic file against the price lists
+# Inputs are read from input_folder, outputs are written to the workspace and named by their path in it
+def run_processing(input_folder, workspace_id, historic_file, price_list_files, output_format='xlsx',
+                   lookup_mode='exact', shard_mode='', plan=FULL_PLAN, progress=no_progress, metrics=None):
+    metrics = metrics or RunMetrics()
+    historic_path = os.path.join(input_folder, historic_file)
+    price_list_paths = [os.path.join(input_folder, price_file) for price_file in price_list_files]
+
+    # Sharded runs process row ranges or Shipment ID hashes of the historic file in independent worker processes
+    if shard_mode:
+        output_file, summary_file, result = output_paths(workspace_id, output_format)
+        duplicates_collapsed = run_sharded_processing(historic_path, price_list_paths, price_list_files, output_file,
+                                                      summary_file, output_format, lookup_mode, shard_mode, plan,
+                                                      progress, metrics)
+        return dict(result, duplicates_collapsed=duplicates_collapsed)
+
+    # Large historic files are processed chunk by chunk so memory stays bounded by the chunk size
+    if os.path.getsize(historic_path) > app.config['STREAMING_THRESHOLD_BYTES']:
+        output_file, summary_file, result = output_paths(workspace_id, output_format)
+        duplicates_collapsed = run_streaming_processing(historic_path, price_list_paths, price_list_files, output_file,
+                                                        summary_file, output_format, lookup_mode, plan, progress,
+                                                        metrics)
+        return dict(result, duplicates_collapsed=duplicates_collapsed)
+
+    # Load the Historic Cost file, with the Adjusted Cost Type (Truck Type for EQUIPMENT)
+    progress(stage='loading')
+    with metrics.stage('read_historic') as stage:
+        historic_df = prepare_historic(read_historic_file(historic_path))
+        stage['rows'] = len(historic_df)
+
+    with metrics.stage('load_price_lists'):
+        price_lists = load_price_lists(price_list_paths, price_list_files)
+
+    return process_historic(workspace_id, historic_df, file_digest(historic_path), price_lists, output_format,
+                            lookup_mode, plan, progress, metrics)
+
+
+# Function recalculating historic data already read against loaded price lists and writing the outputs to the
+# workspace, price_lists is what load_price_lists returns
+def process_historic(workspace_id, historic_df, historic_digest, price_lists, output_format='xlsx', lookup_mode='exact',
+                     plan=FULL_PLAN, progress=no_progress, metrics=None):
+    metrics = metrics or RunMetrics()
+    lane_indexes, price_digests, duplicates_collapsed = price_lists
+    output_file, summary_file, result = output_paths(workspace_id, output_format)
+    cache_keys = result_cache_keys(historic_digest, price_digests, lookup_mode, plan.scenarios)
+    progress(stage='recalculating', rows_done=0, rows_total=len(historic_df))
+
+    # Recalculate every carrier whose price list changed into the long results, the others are reused
+    with metrics.stage('recalculate', rows=len(historic_df)):
+        workers = min(app.config['CARRIER_WORKERS'], uncached_count(cache_keys))
+        with carrier_pool(lane_indexes, workers) as pool:
+            carrier_names, results = calculate_all_carriers(historic_df, lane_indexes, pool, progress, metrics=metrics,
+                                                            cache_keys=cache_keys, lookup_mode=lookup_mode,
+                                                            scenarios=plan.scenarios)
+
+    # Save the results with the new columns per carrier
+    write_output(output_file, summary_file, output_format, historic_df, results, carrier_names, progress, metrics,
+                 plan)
+
+    return dict(result, duplicates_collapsed=duplicates_collapsed)
+
+
+# Function processing the uploads handed over by the upload route: the historic file and price lists are parsed
+# from their spooled streams, then saved to the workspace for its routes when KEEP_UPLOADS is set
+def process_uploads(workspace_id, historic_upload, price_list_uploads, output_format='xlsx', lookup_mode='exact',
+                    plan=FULL_PLAN, progress=no_progress, metrics=None):
+    metrics = metrics or RunMetrics()
+    try:
+        progress(stage='loading')
+        with metrics.stage('read_historic') as stage:
+            historic_digest = file_digest(historic_upload.stream)
+            historic_df = prepare_historic(read_historic_file(historic_upload.stream, historic_upload.filename))
+            stage['rows'] = len(historic_df)
+        with metrics.stage('load_price_lists'):
+            price_lists = load_price_lists([upload.stream for upload in price_list_uploads],
+                                           [upload.filename for upload in price_list_uploads])
+
+        result = process_historic(workspace_id, historic_df, historic_digest, price_lists, output_format,
+                                  lookup_mode, plan, progress, metrics)
+
+        if app.config['KEEP_UPLOADS']:
+            with metrics.stage('keep_uploads'):
+                workspace = workspace_path(workspace_id)
+                result['historic_file'] = save_upload(historic_upload, workspace)
+                result['price_list_files'] = [save_upload(upload, workspace) for upload in price_list_uploads]
+        return result
+    finally:
+        for upload in [historic_upload] + price_list_uploads:
+            upload.stream.release()
+
+
+# Function processing the historic file in chunks: every chunk is recalculated, appended to the results file
+# and added to running scenario totals, so only one chunk of shipments is held in memory at a time
+def run_streaming_processing(historic_path, price_list_paths, price_list_files, output_file, summary_file,
+                             output_format='xlsx', lookup_mode='exact', plan=FULL_PLAN, progress=no_progress,
+                             metrics=None):
+    metrics = metrics or RunMetrics()
+    progress(stage='loading')
+    with metrics.stage('load_price_lists'):
+        lane_indexes, price_digests, duplicates_collapsed = load_price_lists(price_list_paths, price_list_files)
+        historic_digest = file_digest(historic_path)
+    progress(stage='recalculating', rows_done=0, rows_total=None)  # Unknown until the last chunk is read
+
+    wb = Workbook(write_only=True)
+    writer = open_results_writer(output_file, output_format, wb)
+    totals = dict.fromkeys(plan.groupings)
+
+    rows_done = 0
+    header_written = False
+    chunk_size = app.config['HISTORIC_CHUNK_SIZE']
+    chunks = iter_historic_chunks(historic_path, chunk_size)
+    # Results are cached per chunk, the first chunk tells how many carriers changed since the last run
+    chunk_keys = (result_cache_keys(historic_digest, price_digests, lookup_mode, plan.scenarios, f'{chunk_size}x{n}')
+                  for n in itertools.count())
+    workers = min(app.config['CARRIER_WORKERS'], uncached_count(result_cache_keys(
+        historic_digest, price_digests, lookup_mode, plan.scenarios, f'{chunk_size}x0')))
+    with carrier_pool(lane_indexes, workers) as pool:
+        while True:
+            with metrics.stage('read_historic') as stage:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                prepare_historic(chunk)
+                stage['rows'] = len(chunk)
+
+            with metrics.stage('recalculate', rows=len(chunk)):
+                carrier_names, results = calculate_all_carriers(chunk, lane_indexes, pool, progress, rows_done, metrics,
+                                                                next(chunk_keys), lookup_mode, plan.scenarios)
+
+            with metrics.stage('write_results', rows=len(chunk)):
+                writer.write(export_frame(chunk, split_results(results), carrier_names, plan.scenarios))
+                header_written = True
+            with metrics.stage('summary_totals', rows=len(results)):
+                for group_by in plan.groupings:
+                    partial_totals = aggregate_totals(chunk, results, carrier_names, group_by, plan.scenarios)
+                    totals[group_by] = merge_totals(totals[group_by], partial_totals)
+
+            rows_done += len(chunk)
+            progress(stage='writing', carrier=None, rows_done=rows_done)
+
+    if not header_written:
+        totals = write_empty_results(writer, historic_path, lane_indexes, plan)
+    writer.close()
+
+    write_scenario_sheets(wb, totals, metrics, plan)
+    write_cube(output_file, totals, metrics)
+    with metrics.stage('save_workbook'):
+        wb.save(summary_file)
+    return duplicates_collapsed
+
+
+# Function to write the header of a historic file without rows, returning its zero totals
+def write_empty_results(writer, historic_path, lane_indexes, plan=FULL_PLAN):
+    empty = prepare_historic(read_historic_file(historic_path))
+    carrier_names, results = calculate_all_carriers(empty, lane_indexes, scenarios=plan.scenarios)
+    writer.write(export_frame(empty, split_results(results), carrier_names, plan.scenarios))
+    return {group_by: aggregate_totals(empty, results, carrier_names, group_by, plan.scenarios)
+            for group_by in plan.groupings}
+
+
+# Function run by a shard worker (an independent process standing in for a worker node): recalculate the shipments
+# of a shard file against the price lists, write their results rows to the part file and return the partial
+# totals of every summary breakdown with the lookup counts
+def process_shard(shard_path, part_path, lane_indexes, lookup_mode='exact', plan=FULL_PLAN):
+    metrics = RunMetrics()
+    totals = dict.fromkeys(plan.groupings)
+    rows = 0
+    with open(part_path, 'wb') as part:
+        for chunk in read_shard(shard_path):
+            prepare_historic(chunk)
+            carrier_names, results = calculate_all_carriers(chunk, lane_indexes, metrics=metrics,
+                                                            lookup_mode=lookup_mode, scenarios=plan.scenarios)
+            pickle.dump(export_frame(chunk, split_results(results), carrier_names, plan.scenarios), part,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            for group_by in plan.groupings:
+                totals[group_by] = merge_totals(totals[group_by], aggregate_totals(chunk, results, carrier_names,
+                                                                                   group_by, plan.scenarios))
+            rows += len(chunk)
+    return {'rows': rows, 'totals': totals, 'lookups': metrics.lookups}
+
+
+def shard_worker(shard_path, part_path, lookup_mode, plan):
+    return process_shard(shard_path, part_path, WORKER_LANE_INDEXES, lookup_mode, plan)
+
+
+# Helper function to read the frames appended to a shard or part file
+def read_shard(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+# Function to start processing a shard in the shard pool, or right away without one
+def submit_shard(pool, lane_indexes, shard_path, part_path, lookup_mode, plan):
+    if pool is not None:
+        return pool.submit(shard_worker, shard_path, part_path, lookup_mode, plan)
+    future = Future()
+    future.set_result(process_shard(shard_path, part_path, lane_indexes, lookup_mode, plan))
+    return future
+
+
+# Function to split the historic file into shard files, shards of a row range are processed as soon as they are
+# complete; returns the part files with their futures in shard order and the groups of every summary breakdown in
+# order of first appearance
+def split_shards(historic_path, shard_folder, lane_indexes, pool, lookup_mode, shard_mode, plan, metrics):
+    shard_count = app.config['SHARD_COUNT']
+    shard_rows = app.config['SHARD_ROWS']
+    shards = []
+    group_order = {group_by: pd.Index([]) for group_by in plan.groupings if isinstance(group_by, str)}
+
+    def shard_file(number):
+        while len(shards) <= number:
+            shard_path = os.path.join(shard_folder, f'shard-{len(shards):05d}.pkl')
+            shards.append((shard_path, open(shard_path, 'wb')))
+        return shards[number][1]
+
+    def start(number):
+        shard_path, shard = shards[number]
+        shard.close()
+        part_path = shard_path.replace('shard-', 'part-')
+        return part_path, submit_shard(pool, lane_indexes, shard_path, part_path, lookup_mode, plan)
+
+    parts = []
+    rows_done = 0
+    for chunk in iter_historic_chunks(historic_path, app.config['HISTORIC_CHUNK_SIZE']):
+        with metrics.stage('split_shards', rows=len(chunk)):
+            if shard_mode == 'hash':
+                for group_by in group_order:
+                    group_order[group_by] = group_order[group_by].append(
+                        pd.Index(summary_groups(chunk, group_by))).unique()
+                hashes = pd.util.hash_array(chunk['Shipment ID'].astype(str).to_numpy(dtype=object))
+                numbers = (hashes % np.uint64(shard_count)).astype(np.int64)
+                for number in range(shard_count):
+                    pickle.dump(chunk[numbers == number], shard_file(number), protocol=pickle.HIGHEST_PROTOCOL)
+            else:
+                # Row ranges: rows_done + i is the row number of the chunk's i-th row
+                while len(chunk):
+                    number = rows_done // shard_rows
+                    part = chunk.iloc[:(number + 1) * shard_rows - rows_done]
+                    pickle.dump(part, shard_file(number), protocol=pickle.HIGHEST_PROTOCOL)
+                    chunk = chunk.iloc[len(part):]
+                    rows_done += len(part)
+                    if rows_done % shard_rows == 0:
+                        parts.append(start(number))
+
+    # The last row range and every hash shard are complete once the whole file is read
+    parts.extend(start(number) for number in range(len(parts), len(shards)))
+    return parts, group_order
+
+
+# Helper function to put the groups of merged totals in their order of first appearance in the historic file
+def order_groups(totals, groups):
+    positions = totals.historic.index.get_indexer(groups)
+    return ScenarioTotals(totals.historic.take(positions), totals.carriers.take(positions))
+
+
+# Function processing the historic file in shards: the coordinator splits it by row range or Shipment ID hash,
+# independent worker processes recalculate every shard into a part file with partial totals, and the coordinator
+# merges the parts into the results file and the partial totals into the planned scenario sheets
+# (hash shards list their shipments shard after shard, the scenario sheets are the same as for a single run)
+def run_sharded_processing(historic_path, price_list_paths, price_list_files, output_file, summary_file,
+                           output_format='xlsx', lookup_mode='exact', shard_mode='range', plan=FULL_PLAN,
+                           progress=no_progress, metrics=None):
+    metrics = metrics or RunMetrics()
+    progress(stage='loading')
+    with metrics.stage('load_price_lists'):
+        lane_indexes, _, duplicates_collapsed = load_price_lists(price_list_paths, price_list_files)
+    progress(stage='recalculating', rows_done=0, rows_total=None)  # Unknown until the last shard is done
+
+    wb = Workbook(write_only=True)
+    writer = open_results_writer(output_file, output_format, wb)
+    totals = dict.fromkeys(plan.groupings)
+
+    # Shard and part files are temporary files of the run's workspace
+    shard_folder = tempfile.mkdtemp(prefix='shards-', dir=os.path.dirname(output_file))
+    try:
+        workers = app.config['SHARD_WORKERS']
+        with (shard_pool(lane_indexes, workers) if workers > 1 else contextlib.nullcontext()) as pool:
+            parts, group_order = split_shards(historic_path, shard_folder, lane_indexes, pool, lookup_mode,
+                                              shard_mode, plan, metrics)
+
+            rows_done = 0
+            for part_path, future in parts:
+                with metrics.stage('process_shards'):
+                    shard = future.result()
+                for carrier_name, lookups in shard['lookups'].items():
+                    metrics.add_lookups(carrier_name, lookups)
+                with metrics.stage('write_results', rows=shard['rows']):
+                    for frame in read_shard(part_path):
+                        writer.write(frame)
+                with metrics.stage('summary_totals'):
+                    for group_by in plan.groupings:
+                        totals[group_by] = merge_totals(totals[group_by], shard['totals'][group_by])
+                rows_done += shard['rows']
+                progress(stage='writing', carrier=None, rows_done=rows_done)
+    finally:
+        shutil.rmtree(shard_folder, ignore_errors=True)
+
+    if not parts:
+        totals = write_empty_results(writer, historic_path, lane_indexes, plan)
+    elif shard_mode == 'hash':
+        totals = {group_by: order_groups(group_totals, group_order[group_by]) if group_by in group_order else group_totals
+                  for group_by, group_totals in totals.items()}
+    writer.close()
+
+    write_scenario_sheets(wb, totals, metrics, plan)
+    write_cube(output_file, totals, metrics)
+    with metrics.stage('save_workbook'):
+        wb.save(summary_file)
+    return duplicates_collapsed
+
+
+# Function to scale the totals of a breakdown for every point of a tariff sensitivity sweep
+# A point maps carrier names to a factor on all their prices or to factors per Adjusted Cost Type; every lane a
+# shipment can match has the shipment's Adjusted Cost Type, so a factor scales its recalculated and minimum
+# simulation costs alike (a positive factor never changes the cheapest Rate Geography) and the costs summed once
+# per group and cost type are enough to evaluate all points as one array operation
+# Returns the ScenarioTotals of every point
+def sweep_totals(historic_df, results, carrier_names, group_by, scenarios, points):
+    totals = aggregate_totals(historic_df, results, carrier_names, group_by, scenarios)
+    cost_type_totals = aggregate_totals(historic_df, results, carrier_names, 'Adjusted Cost Type' if group_by is None
+                                        else (group_by, 'Adjusted Cost Type'), scenarios)
+
+    # Group and cost type of every row of the costs per cost type
+    index = cost_type_totals.carriers.index
+    if group_by is None:
+        group_positions = np.zeros(len(index), dtype=np.int64)
+    else:
+        group_positions = totals.historic.index.get_indexer(index.get_level_values(0))
+    cost_type_codes, cost_types = pd.factorize(index.get_level_values(-1), use_na_sentinel=False)
+
+    # Factor of every point, carrier and cost type
+    factors = np.ones((len(points), len(carrier_names), len(cost_types)))
+    for p, point in enumerate(points):
+        for carrier_name, adjustment in point.items():
+            carrier = carrier_names.index(carrier_name)
+            if isinstance(adjustment, dict):
+                for cost_type, factor in adjustment.items():
+                    factors[p, carrier, cost_types == cost_type] = factor
+            else:
+                factors[p, carrier] = adjustment
+
+    # Scale the costs of every point, then sum the cost types of every group
+    carrier_codes = np.repeat(np.arange(len(carrier_names)), len(scenarios))  # Columns are (Carrier, Scenario)
+    scaled = cost_type_totals.carriers.to_numpy() * factors[:, carrier_codes[None, :], cost_type_codes[:, None]]
+    membership = np.zeros((len(totals.historic), len(index)))
+    membership[group_positions, np.arange(len(index))] = 1.0
+    adjusted = membership @ scaled
+    return [ScenarioTotals(totals.historic, pd.DataFrame(values, index=totals.carriers.index,
+                                                         columns=totals.carriers.columns)) for values in adjusted]
+
+
+# Helper function to describe a point of a sweep in its sheets
+def sweep_label(point):
+    return json.dumps(point) if point else 'Baseline'
+
+
+# Function to add a sheet per planned scenario to the sweep workbook: the ranked carriers of every point and group
+def write_sweep_sheets(wb, sweeps, points, plan):
+    for sheet_name, group_by, scenario, cost_header in plan.sheets:
+        ws = wb.create_sheet(sheet_name)
+        ws.append(['Point', 'Adjustment'] + ([] if group_by is None else [group_by]) +
+                  ['Total Historic Cost', 'Carrier Name', cost_header, 'Total Difference', 'Rank', '% Difference'])
+        for p, point_totals in enumerate(sweeps[group_by]):
+            for group, total_historic_cost, carrier_data in rank_carriers(point_totals, scenario):
+                group_cells = [] if group_by is None else [None if pd.isna(group) else group]
+                for idx, carrier in enumerate(carrier_data):
+                    ws.append([p, sweep_label(points[p])] + group_cells +
+                              [total_historic_cost, carrier['carrier_name'], carrier['total_cost'],
+                               carrier['total_difference'], idx + 1, carrier['percent_difference']])
+
+
+# Function running a tariff sensitivity sweep: the carriers are recalculated once (or reused from the result
+# cache), then the planned scenario totals are evaluated for the baseline and every price adjustment point
+def run_sweep(input_folder, workspace_id, historic_file, price_list_files, points, lookup_mode='exact',
+              plan=FULL_PLAN, progress=no_progress, metrics=None):
+    metrics = metrics or RunMetrics()
+    historic_path = os.path.join(input_folder, historic_file)
+    price_list_paths = [os.path.join(input_folder, price_file) for price_file in price_list_files]
+    points = [{}] + points
+
+    progress(stage='loading')
+    with metrics.stage('read_historic') as stage:
+        historic_df = prepare_historic(read_historic_file(historic_path))
+        stage['rows'] = len(historic_df)
+    with metrics.stage('load_price_lists'):
+        lane_indexes, price_digests, duplicates_collapsed = load_price_lists(price_list_paths, price_list_files)
+
+    cache_keys = result_cache_keys(file_digest(historic_path), price_digests, lookup_mode, plan.scenarios)
+    progress(stage='recalculating', rows_done=0, rows_total=len(historic_df))
+    with metrics.stage('recalculate', rows=len(historic_df)):
+        workers = min(app.config['CARRIER_WORKERS'], uncached_count(cache_keys))
+        with carrier_pool(lane_indexes, workers) as pool:
+            carrier_names, results = calculate_all_carriers(historic_df, lane_indexes, pool, progress, metrics=metrics,
+                                                            cache_keys=cache_keys, lookup_mode=lookup_mode,
+                                                            scenarios=plan.scenarios)
+
+    with metrics.stage('sweep_totals', rows=len(points)):
+        sweeps = {group_by: sweep_totals(historic_df, results, carrier_names, group_by, plan.scenarios, points)
+                  for group_by in dict.fromkeys(group_by for _, group_by, _, _ in plan.sheets)}
+
+    output_file = os.path.join(workspace_path(workspace_id), SWEEP_NAME + '.xlsx')
+    wb = Workbook(write_only=True)
+    with metrics.stage('write_sweep', rows=len(points)):
+        write_sweep_sheets(wb, sweeps, points, plan)
+    with metrics.stage('save_workbook'):
+        wb.save(output_file)
+    return {'output_file': f'{workspace_id}/{os.path.basename(output_file)}', 'summary_file': None,
+            'points': len(points), 'duplicates_collapsed': duplicates_collapsed}
+
+
+# Lane prices of a price list in a plain dict keyed by (SOURCE, DESTINATION, Adjusted Cost Type), so a single
+# shipment is quoted with dict lookups instead of the vectorized matching used for whole historic files
+class QuoteTable:
+    def __init__(self, lane_index):
+        # Decode the integer lane keys back into their locations and cost type
+        lanes, cost_type_codes = np.divmod(lane_index.keys.to_numpy(), len(lane_index.cost_types))
+        source_codes, destination_codes = np.divmod(lanes, len(lane_index.locations))
+        locations = lane_index.locations.to_numpy(dtype=object)
+        self.prices = dict(zip(zip(locations[source_codes].tolist(), locations[destination_codes].tolist(),
+                                   lane_index.cost_types.to_numpy(dtype=object)[cost_type_codes].tolist()),
+                               lane_index.prices.tolist()))
+        self.prefix_lengths = lane_index.prefix_lengths
+
+    # Price of a single lane, None when the price list has no match
+    def get(self, source, destination, adjusted_cost_type):
+        return self.prices.get((source, destination, adjusted_cost_type))
+
+    # Locations tried for a side of a lane by the fallback lookup: the exact location, then one prefix per
+    # prefix length (None when not shorter than the location) for a postal side
+    def levels(self, location, postal):
+        if not postal or location is None:
+            return [location]
+        return [location] + [location[:length] if len(location) > length else None for length in self.prefix_lengths]
+
+
+# Quote tables of the price lists, kept between requests and keyed by file and modification time
+RESIDENT_QUOTE_TABLES = collections.OrderedDict()
+RESIDENT_QUOTE_LOCK = threading.Lock()
+
+
+# Function to get the resident quote table of a price list, loading it through the price list cache when needed
+def resident_quote_table(path):
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+    with RESIDENT_QUOTE_LOCK:
+        quote_table = RESIDENT_QUOTE_TABLES.get(key)
+        if quote_table is not None:
+            RESIDENT_QUOTE_TABLES.move_to_end(key)
+            return quote_table
+
+    quote_table = QuoteTable(load_price_list(path))
+    with RESIDENT_QUOTE_LOCK:
+        RESIDENT_QUOTE_TABLES[key] = quote_table
+        while len(RESIDENT_QUOTE_TABLES) > app.config['QUOTE_RESIDENT_PRICE_LISTS']:
+            RESIDENT_QUOTE_TABLES.popitem(last=False)
+    return quote_table
+
+
+# Helper function to read a text field of a quoted shipment like the historic file does, None when missing
+def quote_text(shipment, column):
+    value = shipment.get(column)
+    return None if value is None or value == '' else str(value)
+
+
+# Helper function to read a numeric field of a quoted shipment, NaN when missing
+def quote_number(shipment, column):
+    value = shipment.get(column)
+    return np.nan if value is None or value == '' else float(value)
+
+
+# Function to look up the prices of one shipment for all Rate Geographies, with the rules of build_lane_keys
+def quote_prices(shipment, quote_table, act, lookup_mode='exact'):
+    prices = {}
+    for rate_type, (source, destination) in RATE_GEOGRAPHY_COLUMNS.items():
+        source, destination = quote_text(shipment, source), quote_text(shipment, destination)
+        prices[rate_type] = quote_table.get(source, destination, act) if None not in (source, destination, act) else None
+    if lookup_mode != 'fallback':
+        return prices
+
+    fallback_prices = {}
+    for rate_type, (source, destination) in RATE_GEOGRAPHY_COLUMNS.items():
+        if 'POSTAL' not in rate_type or prices[rate_type] is not None:
+            continue
+        sources = quote_table.levels(quote_text(shipment, source), 'Postal' in source)
+        destinations = quote_table.levels(quote_text(shipment, destination), 'Postal' in destination)
+        for i, j in prefix_level_pairs(len(sources), len(destinations)):
+            if None not in (sources[i], destinations[j], act):
+                fallback_prices[rate_type] = quote_table.get(sources[i], destinations[j], act)
+                if fallback_prices[rate_type] is not None:
+                    break
+        else:
+            fallback_prices[rate_type] = prices[region_rate_type(rate_type)]
+    prices.update(fallback_prices)
+    return prices
+
+
+# Function to quote one shipment against one price list with the rules of calculate_costs_and_prices and
+# MinimumSimulation: the cost under the shipment's own Rate Geography and under the cheapest simulated one
+def quote_shipment(shipment, quote_table, lookup_mode='exact'):
+    cost_type = quote_text(shipment, 'Cost Type')
+    act = quote_text(shipment, 'Truck Type') if cost_type == 'EQUIPMENT' else cost_type
+    multiplier = quote_number(shipment, 'Traveled Distance') if cost_type == 'KM' else (
+        quote_number(shipment, 'Weight') if cost_type == 'KG' else 1.0)
+
+    quotes = {}
+    for rate_type, price in quote_prices(shipment, quote_table, act, lookup_mode).items():
+        if price is not None:
+            quotes[rate_type] = {'rate_geography': rate_type, 'cost': price * multiplier, 'price': price}
+
+    # Missing costs never win; ties resolve in SIMULATION_RATE_TYPES order
+    best = None
+    for rate_type in SIMULATION_RATE_TYPES:
+        quote = quotes.get(rate_type)
+        if quote is not None and not np.isnan(quote['cost']) and (best is None or quote['cost'] < best['cost']):
+            best = quote
+    return {'recalculated': quotes.get(quote_text(shipment, 'Rate Geography')), 'minimum_simulation': best}
+
+
+# Helper function to replace the NaN costs of a quote by None, JSON has no NaN
+def json_quote(quote):
+    if quote is None:
+        return None
+    return {field: None if isinstance(value, float) and np.isnan(value) else value for field, value in quote.items()}
+
+
+# Background processing job, polled through its status route
+class Job:
+    def __init__(self, workspace_id, profile=False):
+        # The job id starts with the workspace id, so every server process finds the job's state file
+        self.id = workspace_id + uuid.uuid4().hex[:8]
+        self.workspace_id = workspace_id
+        self.created = time.time()
+        self.profile = profile
+        self.metrics = RunMetrics()
+        self.metrics.run_id = self.id
+        self.status = 'queued'
+        self.stage = None
+        self.carrier = None
+        self.rows_done = 0
+        self.rows_total = 0
+        self.error = None
+        self.result = None
+        self.saved = 0.0
+
+    # Progress callback handed to the processing stages, the state file is rewritten at most every
+    # JOB_SAVE_INTERVAL_SECONDS unless the status changes
+    def update(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+        if 'status' in fields or time.time() - self.saved >= JOB_SAVE_INTERVAL_SECONDS:
+            self.save()
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'workspace_id': self.workspace_id,
+            'status': self.status,
+            'stage': self.stage,
+            'carrier': self.carrier,
+            'rows_done': self.rows_done,
+            'rows_total': self.rows_total,
+            'error': self.error
+        }
+
+    # Full state of the job as kept in its state file
+    def state(self):
+        return dict(self.to_dict(), created=self.created, result=self.result, metrics=self.metrics.to_dict())
+
+    def save(self):
+        self.saved = time.time()
+        state = json.dumps(self.state(), default=str).encode()
+        atomic_write(job_state_path(self.id), lambda f: f.write(state))
+
+
+# Seconds between two writes of a running job's state file
+JOB_SAVE_INTERVAL_SECONDS = 1.0
+
+# Jobs queued or running in this server process; the state of every job is kept in a file of its workspace, so
+# any server process answers for it and the queue bound holds across processes
+JOBS = {}
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'])
+JOB_QUEUE_LOCK = os.path.join(UPLOAD_FOLDER, 'jobs.lock')
+
+
+# Helper function to get the state file of a job in its workspace, 404 for an id that is not a job id
+def job_state_path(job_id):
+    if not re.fullmatch(r'[0-9a-f]{40}', job_id):
+        abort(404)
+    return os.path.join(workspace_path(job_id[:32]), f'job-{job_id}.json')
+
+
+# Function to get the state of a job, live from this process or from its state file, None for an unknown job
+def job_state(job_id):
+    job = JOBS.get(job_id)
+    if job is not None:
+        return job.state()
+    try:
+        with open(job_state_path(job_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+# Function to list the state files of all jobs, with their modification times
+def job_state_files():
+    for workspace in os.scandir(WORKSPACE_FOLDER):
+        if not workspace.is_dir():
+            continue
+        with contextlib.suppress(FileNotFoundError):
+            for entry in os.scandir(workspace.path):
+                if entry.name.startswith('job-') and entry.name.endswith('.json'):
+                    with contextlib.suppress(FileNotFoundError):
+                        yield entry.path, entry.stat().st_mtime
+
+
+# Function to count the jobs queued or running in any server process
+# (a state file not written for longer than the maximum workspace age is left behind by a crashed process)
+def active_job_count():
+    now = time.time()
+    count = 0
+    for path, mtime in job_state_files():
+        if now - mtime > app.config['WORKSPACE_MAX_AGE_SECONDS']:
+            continue
+        with contextlib.suppress(FileNotFoundError, ValueError), open(path) as f:
+            count += json.load(f)['status'] in ('queued', 'running')
+    return count
+
+
+# Context manager holding the lock of the job queue across server processes (within this process only where
+# file locks are not available)
+@contextlib.contextmanager
+def job_queue_lock():
+    with JOB_QUEUE_THREAD_LOCK, open(JOB_QUEUE_LOCK, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+JOB_QUEUE_THREAD_LOCK = threading.Lock()
+
+
+# Function executed on the job thread pool
+def run_job(job, function, *args):
+    # cProfile only sees the job thread, carriers recalculated in worker processes are not in the dump
+    profiler = cProfile.Profile() if job.profile else None
+    running_marker = os.path.join(workspace_path(job.workspace_id), RUNNING_MARKER)
+    try:
+        open(running_marker, 'w').close()
+        job.update(status='running')
+        if profiler is not None:
+            profiler.enable()
+        job.result = function(*args, progress=job.update, metrics=job.metrics)
+        job.update(stage='finished', carrier=None)
+        job.status = 'finished'
+    except Exception as e:
+        app.logger.exception(f'Job {job.id} failed')
+        job.update(error=str(e))
+        job.status = 'failed'
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            job.metrics.profile_file = os.path.join(workspace_path(job.workspace_id), f'{job.id}.prof')
+            profiler.dump_stats(job.metrics.profile_file)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(running_marker)
+        job.metrics.finish()
+        # The state file answers for the job from now on
+        job.save()
+        JOBS.pop(job.id, None)
+
+
+# Function to queue a job, returns None when JOB_QUEUE_SIZE jobs are already queued or running
+def submit_job(function, *args, workspace_id, profile=False):
+    with job_queue_lock():
+        if active_job_count() >= app.config['JOB_QUEUE_SIZE']:
+            return None
+        job = Job(workspace_id, profile)
+        job.save()
+
+    JOBS[job.id] = job
+    JOB_EXECUTOR.submit(run_job, job, function, *args)
+    return job
+
+
+# Helper function to read the output format, lookup mode, shard mode and run plan a run asks for, with an error
+# for unknown ones (scenarios are sheet names, repeated or comma separated, all of them when none are given)
+def run_options():
+    output_format = request.values.get('format', app.config['OUTPUT_FORMAT'])
+    if output_format not in OUTPUT_FORMATS:
+        return None, None, None, None, f'Unknown output format {output_format}, use one of {", ".join(OUTPUT_FORMATS)}'
+    lookup_mode = request.values.get('lookup', app.config['LOOKUP_MODE'])
+    if lookup_mode not in LOOKUP_MODES:
+        return None, None, None, None, f'Unknown lookup mode {lookup_mode}, use one of {", ".join(LOOKUP_MODES)}'
+    shard_mode = request.values.get('shard', app.config['SHARD_MODE'])
+    if shard_mode and shard_mode not in SHARD_MODES:
+        return None, None, None, None, f'Unknown shard mode {shard_mode}, use one of {", ".join(SHARD_MODES)}'
+    sheet_names = [name for value in request.values.getlist('scenarios') for name in value.split(',') if name]
+    unknown = [name for name in sheet_names if name not in SCENARIO_SHEET_NAMES]
+    if unknown:
+        return None, None, None, None, f'Unknown scenario {unknown[0]}, use any of {", ".join(SCENARIO_SHEET_NAMES)}'
+    return output_format, lookup_mode, shard_mode, plan_run(sheet_names), None
+
+
+# Helper function to check the input files of a run are plain file names found in its input folder, 404 otherwise
+def check_input_files(input_folder, input_files):
+    for input_file in input_files:
+        if os.path.basename(input_file) != input_file or not os.path.isfile(os.path.join(input_folder, input_file)):
+            abort(404)
+
+
+# Function to queue the processing of input files, the outputs are written to the given workspace
+# (?format= chooses the results format: xlsx, csv, csv.gz or parquet, ?lookup= the lookup mode: exact or fallback,
+# ?shard= processes the file in shards split by range or hash, ?scenarios= only computes the listed scenario sheets,
+# ?profile=1 adds a cProfile dump)
+def start_processing(input_folder, workspace_id, historic_file, price_list_files):
+    output_format, lookup_mode, shard_mode, plan, error = run_options()
+    if error:
+        return error, 400
+    price_list_files = [price_file for price_file in price_list_files.split(',') if price_file]
+    if not price_list_files:
+        return 'At least one price list is needed', 400
+    check_input_files(input_folder, [historic_file] + price_list_files)
+
+    profile = app.config['PROFILE_RUNS'] or request.values.get('profile') == '1'
+    job = submit_job(run_processing, input_folder, workspace_id, historic_file, price_list_files,
+                     output_format, lookup_mode, shard_mode, plan, workspace_id=workspace_id, profile=profile)
+    if job is None:
+        return 'Too many processing jobs are queued, please try again later', 503
+    return redirect(url_for('job_results', job_id=job.id))
+
+
+# Processing Route - Recalculation and Simulation of the files uploaded to a workspace, queued as a background job
+@app.route('/process/<workspace_id>/<historic_file>/<price_list_files>')
+def process_workspace(workspace_id, historic_file, price_list_files):
+    workspace = workspace_path(workspace_id)
+    if not os.path.isdir(workspace):
+        abort(404)
+    return start_processing(workspace, workspace_id, historic_file, price_list_files)
+
+
+# Processing Route for files placed directly in the uploads folder, the outputs go to a new workspace
 @app.route('/process/<historic_file>/<price_list_files>')
 def process_files(historic_file, price_list_files):
-    historic_path = os.path.join(UPLOAD_FOLDER, historic_file)
-    price_list_files = price_list_files.split(',')
-
-    # Load the Historic Cost file
-    historic_df = pd.read_excel(historic_path)
-
-    # Define custom column names based on the observed structure
-    custom_column_names = [
-        'Shipment ID', 'Shipment Date', 'Carrier', 'Mode', 'Movement',
-        'Source Location', 'Source City', 'Source Postal', 'Source Region',
-        'Destination Location', 'Destination City', 'Destination Postal',
-        'Destination Region', 'Weight', 'Volume', 'Loading Meters',
-        'Truck Type', 'Traveled Distance', 'Total Cost', 'Rate Geography',
-        'Cost Type', 'Remarks', 'User Own Reference'
-    ]
-    historic_df.columns = custom_column_names
-
-    # Create Adjusted Cost Type based on Truck Type for EQUIPMENT
-    historic_df['Adjusted Cost Type'] = historic_df.apply(
-        lambda row: row['Truck Type'] if row['Cost Type'] == 'EQUIPMENT' else row['Cost Type'],
-        axis=1
-    )
-
-    # Load the price list files into separate DataFrames
-    price_df_list = [pd.read_excel(os.path.join(UPLOAD_FOLDER, price_file)) for price_file in price_list_files]
-
-    all_results = []
-    for i, price_df in enumerate(price_df_list):
-        carrier_name = f"carrier{i + 1}"
-        price_df['Lane'] = price_df['SOURCE'] + '-' + price_df['DESTINATION']
-        price_df['Adjusted Cost Type'] = price_df.apply(
-            lambda row: row['Truck Type'] if row['Cost Type'] == 'EQUIPMENT' else row['Cost Type'],
-            axis=1
-        )
-
-        # Part 1: Calculate Recalculated Cost and Price Using the Original Rate Geography
-        recalculated_cost, recalculated_price = zip(*historic_df.apply(
-            lambda row: calculate_cost_and_price(row, price_df, row['Rate Geography']),
-            axis=1
-        ))
-        historic_df[f'{carrier_name}_Recalculated_Cost'] = recalculated_cost
-        historic_df[f'{carrier_name}_Recalculated_Price'] = recalculated_price
-
-        # Calculate the difference between the historic cost and the recalculated cost
-        historic_df[f'{carrier_name}_Difference'] = historic_df[f'{carrier_name}_Recalculated_Cost'] - historic_df['Total Cost']
-
-        # Calculate the percentage difference between the recalculated cost and the historic cost
-        historic_df[f'{carrier_name}_Recalculated_Percentage'] = (historic_df[f'{carrier_name}_Difference'] / historic_df['Total Cost']) * 100
-
-        # Part 2: Simulation - Calculate costs and prices for the remaining 15 geography types
-        simulation_results = {}
-        for rate_type in ['CITY-CITY', 'POSTAL-POSTAL', 'REGION-REGION', 'LOCATION-LOCATION',
-                          'CITY-POSTAL', 'CITY-REGION', 'CITY-LOCATION', 'POSTAL-CITY', 'POSTAL-REGION',
-                          'POSTAL-LOCATION', 'REGION-CITY', 'REGION-POSTAL', 'REGION-LOCATION',
-                          'LOCATION-CITY', 'LOCATION-POSTAL']:
-            sim_col_name = f'{carrier_name}_{rate_type}_Simulation'
-            price_col_name = f'{carrier_name}_{rate_type}_Price'
-            simulation_cost, simulation_price = zip(*historic_df.apply(
-                lambda row: calculate_cost_and_price(row, price_df, rate_type),
-                axis=1
-            ))
-            simulation_results[sim_col_name] = simulation_cost
-            simulation_results[price_col_name] = simulation_price
-
-        # Concat the results for better performance
-        simulation_df = pd.DataFrame(simulation_results)
-        historic_df = pd.concat([historic_df, simulation_df], axis=1)
-
-        # Create Minimum Simulation Cost and Price for the current carrier
-        simulation_columns = [col for col in simulation_results if col.endswith('_Simulation')]
-        historic_df[f'{carrier_name}_Minimum_Simulation_Cost'] = historic_df[simulation_columns].min(axis=1)
-
-        # Calculate the difference between the historic cost and the minimum simulation cost
-        historic_df[f'{carrier_name}_Simulation_Difference'] = historic_df[f'{carrier_name}_Minimum_Simulation_Cost'] - historic_df['Total Cost']
-
-        # Calculate the percentage difference between the simulation cost and the historic cost
-        historic_df[f'{carrier_name}_Simulation_Percentage'] = (historic_df[f'{carrier_name}_Simulation_Difference'] / historic_df['Total Cost']) * 100
-
-        # Find the corresponding minimum price
-        historic_df[f'{carrier_name}_Minimum_Simulation_Price'] = historic_df.apply(
-            lambda row: [historic_df[col.replace('_Simulation', '_Price')][row.name] for col in simulation_columns if
-                         row[col] == row[f'{carrier_name}_Minimum_Simulation_Cost']][0]
-            if pd.notnull(row[f'{carrier_name}_Minimum_Simulation_Cost']) and
-               len([col.replace('_Simulation', '_Price') for col in simulation_columns if
-                    row[col] == row[f'{carrier_name}_Minimum_Simulation_Cost']]) > 0
-            else None,
-            axis=1
-        )
-
-        # Create Minimum Rate Geography for the current carrier
-        historic_df[f'{carrier_name}_Minimum_Rate_Geography'] = historic_df.apply(
-            lambda row: [col.split('_')[1] for col in simulation_columns if
-                         pd.notnull(row[col]) and row[col] == row[f'{carrier_name}_Minimum_Simulation_Cost']][0]
-            if pd.notnull(row[f'{carrier_name}_Minimum_Simulation_Cost']) and
-               len([col.split('_')[1] for col in simulation_columns if
-                    pd.notnull(row[col]) and row[col] == row[f'{carrier_name}_Minimum_Simulation_Cost']]) > 0
-            else None,
-            axis=1
-        )
-
-    # Drop the simulation columns just before saving
-    columns_to_drop = []
-    for i in range(1, len(price_list_files) + 1):
-        carrier_name = f"carrier{i}"
-        for rate_type in ['CITY-CITY', 'POSTAL-POSTAL', 'REGION-REGION', 'LOCATION-LOCATION',
-                          'CITY-POSTAL', 'CITY-REGION', 'CITY-LOCATION', 'POSTAL-CITY', 'POSTAL-REGION',
-                          'POSTAL-LOCATION', 'REGION-CITY', 'REGION-POSTAL', 'REGION-LOCATION',
-                          'LOCATION-CITY', 'LOCATION-POSTAL']:
-            columns_to_drop.append(f'{carrier_name}_{rate_type}_Simulation')
-            columns_to_drop.append(f'{carrier_name}_{rate_type}_Price')
-
-    historic_df = historic_df.drop(columns=columns_to_drop, errors='ignore')
-
-    # Save to Excel with the new columns per carrier
-    output_file = os.path.join(UPLOAD_FOLDER, 'Final_Historic_Cost_per_Carrier_with_Prices.xlsx')
-    historic_df.to_excel(output_file, index=False)
-
-    # Create a summary of total costs per carrier (using dynamically generated carrier names)
-    create_carrier_summary(output_file, historic_df)
-
-    # Create the "Scenario2-BC_Simulation" summary using Minimum Simulation Cost
-    create_carrier_simulation_summary(output_file, historic_df)
-
-    # Create the "Scenario3-Best_Mode" summary with a breakdown by Mode
-    create_mode_summary(output_file, historic_df)
-
-    # Create the "Scenario4-BM_Simulation" summary with a breakdown by Mode using Minimum Simulation Cost
-    create_bm_simulation_summary(output_file, historic_df)
-
-    # Create the
-
-    create_best_movement_summary(output_file, historic_df)
-    create_bmv_simulation_summary(output_file, historic_df)
-
-    return render_template('results_new.html', output_file='Final_Historic_Cost_per_Carrier_with_Prices.xlsx')
-
-# Download Route for the updated file
-@app.route('/download/<output_file>')
+    return start_processing(UPLOAD_FOLDER, create_workspace(), historic_file, price_list_files)
+
+
+# Helper function to get the state of a job for a route, 404 for an unknown job
+def job_state_or_404(job_id):
+    state = job_state(job_id)
+    if state is None:
+        abort(404)
+    return state
+
+
+# Helper function to get the status fields of a job state, without its result and metrics
+def job_status_fields(state):
+    return {name: value for name, value in state.items() if name not in ('created', 'result', 'metrics')}
+
+
+# Status Route for polling the progress of a job
+@app.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    return jsonify(job_status_fields(job_state_or_404(job_id)))
+
+
+# Metrics Route of a job: stage timings, memory and lookup hit rates
+@app.route('/jobs/<job_id>/metrics')
+def job_metrics(job_id):
+    return jsonify(job_state_or_404(job_id)['metrics'])
+
+
+# Metrics Route of the JOB_HISTORY most recent jobs still in their workspaces, newest first
+@app.route('/metrics')
+def all_metrics():
+    states = []
+    for path, _ in job_state_files():
+        job_id = os.path.basename(path)[len('job-'):-len('.json')]
+        state = job_state(job_id)
+        if state is not None:
+            states.append(state)
+    states = sorted(states, key=lambda state: state['created'], reverse=True)[:JOB_HISTORY]
+    return jsonify([dict(state['metrics'], status=state['status']) for state in states])
+
+
+# Results Route of a job, shows the results page once the job has finished
+@app.route('/jobs/<job_id>')
+def job_results(job_id):
+    state = job_state_or_404(job_id)
+    if state['status'] == 'finished':
+        return render_template('results_new.html', **state['result'])
+    if state['status'] == 'failed':
+        return jsonify(job_status_fields(state)), 500
+
+    # Still queued or running, ask the browser to come back
+    return jsonify(job_status_fields(state)), 202, {'Refresh': '5'}
+
+
+# Function to load a results cube, kept in memory between queries while the file is unchanged
+@functools.lru_cache(maxsize=32)
+def load_cube(path, mtime_ns, size):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+# Helper function to turn a cube label into JSON, missing groups become None
+def json_label(label):
+    return None if pd.isna(label) else label
+
+
+# Cube Route of a run's workspace: sums the historic cost and the cost of every carrier and scenario over the
+# cube dimensions (Mode, Movement, Month, Rate Geography)
+# (?by= lists the dimensions to break the totals down by, a dimension given as a parameter keeps only its values,
+# e.g. ?by=Month&Mode=ROAD&Mode=RAIL)
+@app.route('/cube/<workspace_id>')
+def query_cube(workspace_id):
+    path = os.path.join(workspace_path(workspace_id), CUBE_NAME + '.pkl')
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        abort(404)
+    cube = load_cube(path, stat.st_mtime_ns, stat.st_size)
+
+    by = [dimension for dimension in request.args.get('by', '').split(',') if dimension]
+    unknown = [dimension for dimension in by if dimension not in CUBE_DIMENSIONS]
+    if unknown:
+        return jsonify(error=f'Unknown dimension {unknown[0]}, use any of {", ".join(CUBE_DIMENSIONS)}'), 400
+
+    selected = np.ones(len(cube.historic), dtype=bool)
+    for dimension in CUBE_DIMENSIONS:
+        if dimension in request.args:
+            selected &= cube.historic.index.get_level_values(dimension).isin(request.args.getlist(dimension))
+    historic, carriers = cube.historic[selected], cube.carriers[selected]
+
+    if by:
+        historic = historic.groupby(level=by, sort=False, dropna=False, observed=True).sum()
+        carriers = carriers.groupby(level=by, sort=False, dropna=False, observed=True).sum()
+    else:
+        historic, carriers = pd.Series([historic.sum()]), carriers.sum().to_frame().T
+
+    rows = []
+    for labels, historic_cost, costs in zip(historic.index, historic.to_numpy(), carriers.to_numpy()):
+        labels = labels if isinstance(labels, tuple) else (labels,)
+        row = {dimension: json_label(label) for dimension, label in zip(by, labels)}
+        row['Historic Cost'] = float(historic_cost)
+        row['carriers'] = {}
+        for (carrier_name, scenario), cost in zip(carriers.columns, costs):
+            row['carriers'].setdefault(carrier_name, {})[scenario] = float(cost)
+        rows.append(row)
+    return jsonify(dimensions=by, rows=rows)
+
+
+# Download Route for the updated file (workspace ID/file name), sent in blocks with Range and conditional
+# request support so clients can fetch parts of large results or resume an interrupted download
+@app.route('/download/<path:output_file>')
 def download_file(output_file):
-    path = os.path.join(UPLOAD_FOLDER, output_file)
-    return send_file(path, as_attachment=True)
+    workspace_id, _, output_file = output_file.partition('/')
+    workspace = workspace_path(workspace_id)
+    if os.path.isdir(workspace):
+        os.utime(workspace)  # Mark the workspace as recently used for the reaper
+    mimetype = 'application/gzip' if output_file.endswith('.gz') else None
+    return send_from_directory(workspace, output_file, mimetype=mimetype, as_attachment=True, conditional=True)
+
+
+# Function to quote the shipments of a JSON request against price lists, carriers are numbered like the batch runs
+# (the body is one shipment, a list of them or {"shipments": [...]}, keyed by the Historic Cost file column names,
+# ?lookup= chooses the lookup mode: exact or fallback)
+def quote_shipments(input_folder, price_list_files):
+    lookup_mode = request.args.get('lookup', app.config['LOOKUP_MODE'])
+    if lookup_mode not in LOOKUP_MODES:
+        return jsonify(error=f'Unknown lookup mode {lookup_mode}, use one of {", ".join(LOOKUP_MODES)}'), 400
+
+    body = request.get_json(silent=True)
+    shipments = body.get('shipments', body) if isinstance(body, dict) else body
+    shipments = [shipments] if isinstance(shipments, dict) else shipments
+    if not isinstance(shipments, list) or not all(isinstance(shipment, dict) for shipment in shipments):
+        return jsonify(error='Send a shipment, a list of shipments or {"shipments": [...]} as JSON'), 400
+    if len(shipments) > app.config['QUOTE_MAX_SHIPMENTS']:
+        return jsonify(error=f'At most {app.config["QUOTE_MAX_SHIPMENTS"]} shipments can be quoted at once'), 413
+
+    quote_tables = []
+    for price_file in price_list_files.split(','):
+        path = os.path.join(input_folder, price_file)
+        if os.path.basename(price_file) != price_file or not os.path.isfile(path):
+            abort(404)
+        quote_tables.append(resident_quote_table(path))
+
+    quotes = []
+    for shipment in shipments:
+        try:
+            carriers = {f"carrier{i + 1}": quote_shipment(shipment, quote_table, lookup_mode)
+                        for i, quote_table in enumerate(quote_tables)}
+        except (TypeError, ValueError):
+            return jsonify(error=f'Weight and Traveled Distance must be numbers: {shipment}'), 400
+        quotes.append({'shipment': shipment.get('Shipment ID'),
+                       'carriers': {carrier_name: {scenario: json_quote(quote) for scenario, quote in carrier.items()}
+                                    for carrier_name, carrier in carriers.items()}})
+    return jsonify(quotes=quotes)
+
+
+# Quote Route for live shipments against the price lists uploaded to a workspace
+@app.route('/quote/<workspace_id>/<price_list_files>', methods=['POST'])
+def quote_workspace(workspace_id, price_list_files):
+    return quote_shipments(workspace_path(workspace_id), price_list_files)
+
+
+# Quote Route for live shipments against price lists placed directly in the uploads folder
+@app.route('/quote/<price_list_files>', methods=['POST'])
+def quote(price_list_files):
+    return quote_shipments(UPLOAD_FOLDER, price_list_files)
+
+
+# Helper function to read the price adjustment points of a sweep request, with an error for invalid ones
+# ({"adjustments": [{"carrier2": 0.95}, {"carrier2": {"KM": 0.925}}, ...]}, factors are positive numbers)
+def sweep_points(body, carrier_count):
+    points = body.get('adjustments') if isinstance(body, dict) else body
+    if not isinstance(points, list) or not all(isinstance(point, dict) for point in points):
+        return None, 'Send {"adjustments": [...]} as JSON, every point mapping carrier names to a factor or to ' \
+                     'factors per cost type'
+    if len(points) > app.config['SWEEP_MAX_POINTS']:
+        return None, f'At most {app.config["SWEEP_MAX_POINTS"]} adjustment points can be swept at once'
+
+    carrier_names = [f"carrier{i + 1}" for i in range(carrier_count)]
+    for point in points:
+        for carrier_name, adjustment in point.items():
+            if carrier_name not in carrier_names:
+                return None, f'Unknown carrier {carrier_name}, use any of {", ".join(carrier_names)}'
+            factors = adjustment.values() if isinstance(adjustment, dict) else [adjustment]
+            if not all(isinstance(factor, (int, float)) and not isinstance(factor, bool) and 0 < factor < np.inf
+                       for factor in factors):
+                return None, f'Factors must be positive numbers: {point}'
+    return points, None
+
+
+# Function to queue a tariff sensitivity sweep of input files, the sweep workbook is written to the given workspace
+# (?lookup= the lookup mode: exact or fallback, ?scenarios= only sweeps the listed scenario sheets)
+def start_sweep(input_folder, workspace_id, historic_file, price_list_files):
+    _, lookup_mode, _, plan, error = run_options()
+    if error:
+        return jsonify(error=error), 400
+    price_list_files = [price_file for price_file in price_list_files.split(',') if price_file]
+    if not price_list_files:
+        return jsonify(error='At least one price list is needed'), 400
+    check_input_files(input_folder, [historic_file] + price_list_files)
+    points, error = sweep_points(request.get_json(silent=True), len(price_list_files))
+    if error:
+        return jsonify(error=error), 400
+
+    job = submit_job(run_sweep, input_folder, workspace_id, historic_file, price_list_files, points, lookup_mode,
+                     plan, workspace_id=workspace_id)
+    if job is None:
+        return 'Too many processing jobs are queued, please try again later', 503
+    return redirect(url_for('job_results', job_id=job.id))
+
+
+# Sweep Route of the files uploaded to a workspace, the adjustment points are posted as JSON
+@app.route('/sweep/<workspace_id>/<historic_file>/<price_list_files>', methods=['POST'])
+def sweep_workspace(workspace_id, historic_file, price_list_files):
+    workspace = workspace_path(workspace_id)
+    if not os.path.isdir(workspace):
+        abort(404)
+    return start_sweep(workspace, workspace_id, historic_file, price_list_files)
+
+
+# Sweep Route for files placed directly in the uploads folder, the sweep workbook goes to a new workspace
+@app.route('/sweep/<historic_file>/<price_list_files>', methods=['POST'])
+def sweep_files(historic_file, price_list_files):
+    return start_sweep(UPLOAD_FOLDER, create_workspace(), historic_file, price_list_files)
+
 
 if __name__ == '__main__':
     app.run(debug=True)
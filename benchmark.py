@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+import app
+
+# Share of shipments per Rate Geography, LOCATION-REGION is kept to exercise the unsupported path
+RATE_GEOGRAPHY_WEIGHTS = {
+    'POSTAL-POSTAL': 0.30, 'CITY-CITY': 0.20, 'REGION-REGION': 0.12, 'LOCATION-LOCATION': 0.10,
+    'CITY-POSTAL': 0.04, 'POSTAL-CITY': 0.04, 'CITY-REGION': 0.03, 'REGION-CITY': 0.03,
+    'POSTAL-REGION': 0.02, 'REGION-POSTAL': 0.02, 'CITY-LOCATION': 0.02, 'LOCATION-CITY': 0.02,
+    'POSTAL-LOCATION': 0.01, 'LOCATION-POSTAL': 0.01, 'REGION-LOCATION': 0.02, 'LOCATION-REGION': 0.02,
+}
+
+# Share of shipments per Cost Type, EQUIPMENT prices depend on the Truck Type
+COST_TYPE_WEIGHTS = {'KM': 0.40, 'KG': 0.30, 'EQUIPMENT': 0.20, 'FLAT': 0.10}
+
+TRUCK_TYPES = ['FTL', 'LTL', 'REEFER', 'CONTAINER']
+MODES = ['ROAD', 'RAIL', 'SEA', 'AIR']
+MOVEMENTS = ['IMPORT', 'EXPORT', 'DOMESTIC']
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+
+# Helper function to pick values with the given weights
+def weighted_choice(rng, weights, size):
+    values = list(weights)
+    p = np.array([weights[value] for value in values])
+    return np.array(values, dtype=object)[rng.choice(len(values), size=size, p=p / p.sum())]
+
+
+# Function to create the location hierarchy: every location belongs to a postal code, a city and a region
+def generate_locations(rng, locations=2000, cities=400, regions=20):
+    city = rng.integers(cities, size=locations)
+    city_region = rng.integers(regions, size=cities)
+    return pd.DataFrame({
+        'Location': [f'LOC{i:05d}' for i in range(locations)],
+        'City': [f'CITY{c:04d}' for c in city],
+        'Postal': [f'{10000 + c * 100 + i % 100}' for i, c in enumerate(city)],  # Numeric text, like real postal codes
+        'Region': [f'REG{city_region[c]:02d}' for c in city],
+    })
+
+
+# Function to generate a synthetic Historic Cost table in the 23 column layout of the upload
+def generate_historic(rng, rows, locations):
+    # A few busy locations ship most of the volume
+    popularity = 1.0 / np.arange(1, len(locations) + 1) ** 0.8
+    popularity /= popularity.sum()
+    source = locations.iloc[rng.choice(len(locations), size=rows, p=popularity)].reset_index(drop=True)
+    destination = locations.iloc[rng.choice(len(locations), size=rows, p=popularity)].reset_index(drop=True)
+
+    weight = rng.gamma(2.0, 800.0, size=rows).round(1)
+    distance = rng.gamma(3.0, 150.0, size=rows).round(1)
+    cost_type = weighted_choice(rng, COST_TYPE_WEIGHTS, rows)
+    total_cost = np.where(cost_type == 'KM', distance * 1.2, np.where(cost_type == 'KG', weight * 0.15, 900.0))
+
+    historic_df = pd.DataFrame({
+        'Shipment ID': np.arange(1, rows + 1),
+        'Shipment Date': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(366, size=rows), unit='D'),
+        'Carrier': np.array(['HISTORIC1', 'HISTORIC2', 'HISTORIC3'], dtype=object)[rng.integers(3, size=rows)],
+        'Mode': np.array(MODES, dtype=object)[rng.integers(len(MODES), size=rows)],
+        'Movement': np.array(MOVEMENTS, dtype=object)[rng.integers(len(MOVEMENTS), size=rows)],
+        'Source Location': source['Location'], 'Source City': source['City'],
+        'Source Postal': source['Postal'], 'Source Region': source['Region'],
+        'Destination Location': destination['Location'], 'Destination City': destination['City'],
+        'Destination Postal': destination['Postal'], 'Destination Region': destination['Region'],
+        'Weight': weight,
+        'Volume': (weight / 250.0).round(2),
+        'Loading Meters': (weight / 1500.0).round(2),
+        'Truck Type': np.array(TRUCK_TYPES, dtype=object)[rng.integers(len(TRUCK_TYPES), size=rows)],
+        'Traveled Distance': distance,
+        'Total Cost': (total_cost * rng.uniform(0.8, 1.2, size=rows)).round(2),
+        'Rate Geography': weighted_choice(rng, RATE_GEOGRAPHY_WEIGHTS, rows),
+        'Cost Type': cost_type,
+        'Remarks': None,
+        'User Own Reference': [f'REF{i}' for i in range(rows)],
+    })
+    assert list(historic_df.columns) == list(app.HISTORIC_COLUMN_TYPES)
+    return historic_df
+
+
+# Function to generate a price list of the given size where a share of the lanes (overlap) occurs in the
+# historic data, the other lanes use locations the shipments never visit
+def generate_price_list(rng, historic_df, price_rows, overlap, duplicates=0.01):
+    matching = int(round(price_rows * overlap))
+
+    # Sample lanes of random shipments under random Rate Geographies
+    rows = rng.integers(len(historic_df), size=2 * matching)
+    geographies = np.array(list(app.RATE_GEOGRAPHY_COLUMNS), dtype=object)[
+        rng.integers(len(app.RATE_GEOGRAPHY_COLUMNS), size=len(rows))]
+    lanes = []
+    for rate_type, (source, destination) in app.RATE_GEOGRAPHY_COLUMNS.items():
+        sample = historic_df.iloc[rows[geographies == rate_type]]
+        lanes.append(pd.DataFrame({'SOURCE': sample[source].to_numpy(), 'DESTINATION': sample[destination].to_numpy(),
+                                   'Cost Type': sample['Cost Type'].to_numpy(),
+                                   'Truck Type': sample['Truck Type'].to_numpy()}))
+    lanes = pd.concat(lanes, ignore_index=True)
+    lanes = lanes[~pd.concat([lanes[['SOURCE', 'DESTINATION']], app.adjusted_cost_type(lanes)], axis=1).duplicated()]
+    lanes = lanes.iloc[:matching]
+
+    unknown = price_rows - len(lanes)
+    lanes = pd.concat([lanes, pd.DataFrame({
+        'SOURCE': [f'XLOC{i:06d}' for i in range(unknown)],
+        'DESTINATION': [f'XLOC{i + unknown:06d}' for i in range(unknown)],
+        'Cost Type': weighted_choice(rng, COST_TYPE_WEIGHTS, unknown),
+        'Truck Type': np.array(TRUCK_TYPES, dtype=object)[rng.integers(len(TRUCK_TYPES), size=unknown)],
+    })], ignore_index=True)
+
+    lanes['Price'] = np.where(lanes['Cost Type'] == 'KM', rng.uniform(0.8, 1.6, size=len(lanes)),
+                              np.where(lanes['Cost Type'] == 'KG', rng.uniform(0.1, 0.2, size=len(lanes)),
+                                       rng.uniform(600.0, 1200.0, size=len(lanes)))).round(3)
+
+    # Real price lists repeat some lanes, only the first price is used
+    repeated = lanes.sample(frac=duplicates, random_state=rng.integers(2 ** 31))
+    repeated = repeated.assign(Price=repeated['Price'] * 2)
+    return pd.concat([lanes, repeated], ignore_index=True).sample(frac=1.0, random_state=rng.integers(2 ** 31))
+
+
+# Helper function to save a generated table in the requested input format
+def save_table(df, path, file_format):
+    if file_format == 'csv':
+        df.to_csv(path, index=False)
+    elif file_format == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_excel(path, index=False)
+
+
+# Helper function to time one stage and keep its result
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    def __call__(self, stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - start
+        return result
+
+
+# Function to run every processing stage once on the generated files and return the seconds spent per stage
+def run_stages(historic_path, price_list_paths, output_path, output_format='xlsx'):
+    timer = StageTimer()
+
+    def ingest():
+        historic_df = app.read_historic_file(historic_path)
+        historic_df['Adjusted Cost Type'] = app.adjusted_cost_type(historic_df)
+        return app.intern_categories(historic_df)
+
+    def index_price_list(path):
+        price_df = app.read_price_list(path)
+        price_df['Adjusted Cost Type'] = app.adjusted_cost_type(price_df)
+        return app.LaneIndex(price_df)
+
+    historic_df = timer('ingest', ingest)
+    lane_indexes = [timer('price_list_index', index_price_list, path) for path in price_list_paths]
+
+    # The carrier recalculation split in its stages, the same steps calculate_carrier_results runs
+    for lane_index in lane_indexes:
+        lane_keys, original_keys = timer('lane_keys', app.build_lane_keys, historic_df, lane_index)
+        timer('recalculation', app.calculate_costs_and_prices, historic_df, lane_index, original_keys)
+        minimum = app.MinimumSimulation(len(historic_df))
+        for code, rate_type in enumerate(app.SIMULATION_RATE_TYPES):
+            cost, price = timer('simulation', app.calculate_costs_and_prices, historic_df, lane_index,
+                                lane_keys[rate_type])
+            timer('minimum_selection', minimum.add, code, cost, price)
+
+    # End to end carrier results, used by the writing stages
+    carrier_names, results = timer('carriers_total', app.calculate_all_carriers, historic_df, lane_indexes)
+
+    wb = Workbook(write_only=True)
+    writer = app.open_results_writer(output_path + app.OUTPUT_FORMATS[output_format], output_format, wb)
+    timer('write_results', app.write_results, writer, historic_df, results, carrier_names)
+    timer('write_results', writer.close)
+    for sheet_name, group_by, scenario, cost_header in app.SCENARIO_SHEETS:
+        totals = timer(sheet_name, app.aggregate_totals, historic_df, results, carrier_names, group_by)
+        timer(sheet_name, app.create_scenario_summary, wb, sheet_name, totals, group_by, scenario, cost_header)
+    timer('excel_save', wb.save, output_path + '.xlsx')
+
+    return timer.stages
+
+
+# Helper function to identify the measured version of the code
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the processing stages on synthetic shipments and price lists')
+    parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')], default=DEFAULT_SIZES,
+                        help='comma separated historic row counts (default: 10000,100000,1000000)')
+    parser.add_argument('--price-lists', type=int, default=3, help='number of price lists (default: 3)')
+    parser.add_argument('--price-rows', type=int, default=20000, help='rows per price list (default: 20000)')
+    parser.add_argument('--overlap', type=float, default=0.8,
+                        help='share of price list lanes that occur in the historic data (default: 0.8)')
+    parser.add_argument('--format', choices=['csv', 'xlsx', 'parquet'], default='csv', help='input file format')
+    parser.add_argument('--output-format', choices=list(app.OUTPUT_FORMATS), default='xlsx',
+                        help='results file format (default: xlsx)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per size, the fastest time per stage is kept')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the generator')
+    parser.add_argument('--workdir', help='folder for the generated files (default: a temporary folder)')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file the results are written to')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    locations = generate_locations(rng)
+
+    results = []
+    for rows in args.sizes:
+        historic_df = generate_historic(rng, rows, locations)
+        historic_path = os.path.join(workdir, f'historic_{rows}.{args.format}')
+        save_table(historic_df, historic_path, args.format)
+
+        price_list_paths = []
+        for i in range(args.price_lists):
+            price_list_path = os.path.join(workdir, f'price_list_{rows}_{i + 1}.{args.format}')
+            save_table(generate_price_list(rng, historic_df, args.price_rows, args.overlap), price_list_path, args.format)
+            price_list_paths.append(price_list_path)
+        del historic_df
+
+        stages = {}
+        for _ in range(args.repeat):
+            output_path = os.path.join(workdir, f'output_{rows}')
+            run = run_stages(historic_path, price_list_paths, output_path, args.output_format)
+            stages = {stage: min(seconds, stages.get(stage, seconds)) for stage, seconds in run.items()}
+
+        results.append({'rows': rows, 'stages': {stage: round(seconds, 4) for stage, seconds in stages.items()}})
+        print(f'{rows} rows: ' + ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in stages.items()), flush=True)
+
+    report = {
+        'revision': git_revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'parameters': {'price_lists': args.price_lists, 'price_rows': args.price_rows, 'overlap': args.overlap,
+                       'format': args.format, 'output_format': args.output_format, 'repeat': args.repeat,
+                       'seed': args.seed},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
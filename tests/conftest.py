@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+# The app creates its uploads folder and caches in the working directory when it is imported, so the tests run
+# it in a temporary directory
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    os.chdir(tmp_path_factory.mktemp('run'))
+    import app as app_module
+    app_module.app.config['CARRIER_WORKERS'] = 1
+    return app_module
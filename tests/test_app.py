@@ -0,0 +1,339 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Location hierarchy of the fixture shipments: (Location, City, Postal, Region)
+A = ('LOC1', 'CITY1', '1011', 'REG1')
+B = ('LOC2', 'CITY2', '2022', 'REG2')
+C = ('LOC3', 'CITY3', '1033', 'REG1')
+D = ('LOC4', 'CITY4', '2044', 'REG2')
+E = ('LOC5', 'CITY5', '3055', 'REG3')
+
+
+# Helper function to build a fixture shipment in the column layout of the historic file
+def shipment(shipment_id, source, destination, rate_geography, cost_type, truck_type='FTL', distance=100.0,
+             weight=10.0, mode='ROAD', movement='IMPORT', total_cost=250.0):
+    return {
+        'Shipment ID': shipment_id, 'Shipment Date': pd.Timestamp('2024-01-01') + pd.Timedelta(days=40 * shipment_id),
+        'Carrier': 'HISTORIC1', 'Mode': mode, 'Movement': movement,
+        'Source Location': source[0], 'Source City': source[1], 'Source Postal': source[2], 'Source Region': source[3],
+        'Destination Location': destination[0], 'Destination City': destination[1],
+        'Destination Postal': destination[2], 'Destination Region': destination[3],
+        'Weight': weight, 'Volume': 1.0, 'Loading Meters': 1.0, 'Truck Type': truck_type,
+        'Traveled Distance': distance, 'Total Cost': total_cost, 'Rate Geography': rate_geography,
+        'Cost Type': cost_type, 'Remarks': None, 'User Own Reference': f'REF{shipment_id}',
+    }
+
+
+# Shipments covering the pricing rules: KM, KG, EQUIPMENT and flat prices, ties between Rate Geographies, a missing
+# Traveled Distance, a missing location, an unsupported Rate Geography and a lane no price list quotes
+HISTORIC_ROWS = [
+    shipment(1, A, B, 'CITY-CITY', 'KM'),
+    shipment(2, C, D, 'REGION-REGION', 'KG', weight=50.0, mode='RAIL'),
+    shipment(3, A, B, 'LOCATION-LOCATION', 'EQUIPMENT', truck_type='FTL', movement='EXPORT'),
+    shipment(4, A, B, 'CITY-CITY', 'KM', distance=np.nan),
+    shipment(5, A, B, 'BOGUS', 'FLAT', mode='SEA'),
+    shipment(6, E, E, 'CITY-CITY', 'KM', movement='DOMESTIC'),
+    shipment(7, (A[0], None, A[2], A[3]), B, 'CITY-CITY', 'KG', weight=20.0),
+    shipment(8, C, D, 'POSTAL-POSTAL', 'KM', distance=40.0, mode='RAIL', movement='EXPORT'),
+    shipment(9, ('LOC9', 'CITY9', '101199', 'REG1'), B, 'POSTAL-REGION', 'KG', weight=5.0),
+]
+
+# Price list rows (SOURCE, DESTINATION, Cost Type, Truck Type, Price), with a duplicated lane whose second price is
+# never used and a row without a destination
+PRICE_ROWS = [
+    ('CITY1', 'CITY2', 'KM', None, 2.0),
+    ('CITY1', 'CITY2', 'KM', None, 3.0),
+    ('REG1', 'REG2', 'KM', None, 2.0),
+    ('1011', '2022', 'KM', None, 2.5),
+    ('CITY3', 'CITY4', 'KG', None, 1.0),
+    ('REG1', 'REG2', 'KG', None, 1.0),
+    ('LOC1', 'LOC2', 'EQUIPMENT', 'FTL', 500.0),
+    ('LOC1', 'LOC2', 'EQUIPMENT', 'LTL', 400.0),
+    ('CITY1', 'CITY2', 'FLAT', None, 75.0),
+    ('REG1', 'REG2', 'FLAT', None, 75.0),
+    ('1033', '2044', 'KM', None, 1.5),
+    ('1011', 'REG2', 'KG', None, 0.5),
+    ('CITY1', None, 'KM', None, 0.1),
+]
+
+# Rate Geographies simulated by the original code, in its column order
+ORIGINAL_SIMULATION_RATE_TYPES = ['CITY-CITY', 'POSTAL-POSTAL', 'REGION-REGION', 'LOCATION-LOCATION',
+                                  'CITY-POSTAL', 'CITY-REGION', 'CITY-LOCATION', 'POSTAL-CITY', 'POSTAL-REGION',
+                                  'POSTAL-LOCATION', 'REGION-CITY', 'REGION-POSTAL', 'REGION-LOCATION',
+                                  'LOCATION-CITY', 'LOCATION-POSTAL']
+
+
+# The original per-row function the vectorized engine replaced, kept as the reference for its results
+def calculate_cost_and_price(row, price_df, rate_type):
+    # Construct the lane based on each Rate Geography type
+    if rate_type == 'CITY-CITY':
+        lane = f"{row['Source City']}-{row['Destination City']}"
+    elif rate_type == 'POSTAL-POSTAL':
+        lane = f"{row['Source Postal']}-{row['Destination Postal']}"
+    elif rate_type == 'REGION-REGION':
+        lane = f"{row['Source Region']}-{row['Destination Region']}"
+    elif rate_type == 'LOCATION-LOCATION':
+        lane = f"{row['Source Location']}-{row['Destination Location']}"
+    elif rate_type == 'CITY-POSTAL':
+        lane = f"{row['Source City']}-{row['Destination Postal']}"
+    elif rate_type == 'CITY-REGION':
+        lane = f"{row['Source City']}-{row['Destination Region']}"
+    elif rate_type == 'CITY-LOCATION':
+        lane = f"{row['Source City']}-{row['Destination Location']}"
+    elif rate_type == 'POSTAL-CITY':
+        lane = f"{row['Source Postal']}-{row['Destination City']}"
+    elif rate_type == 'POSTAL-REGION':
+        lane = f"{row['Source Postal']}-{row['Destination Region']}"
+    elif rate_type == 'POSTAL-LOCATION':
+        lane = f"{row['Source Postal']}-{row['Destination Location']}"
+    elif rate_type == 'REGION-CITY':
+        lane = f"{row['Source Region']}-{row['Destination City']}"
+    elif rate_type == 'REGION-POSTAL':
+        lane = f"{row['Source Region']}-{row['Destination Postal']}"
+    elif rate_type == 'REGION-LOCATION':
+        lane = f"{row['Source Region']}-{row['Destination Location']}"
+    elif rate_type == 'LOCATION-CITY':
+        lane = f"{row['Source Location']}-{row['Destination City']}"
+    elif rate_type == 'LOCATION-POSTAL':
+        lane = f"{row['Source Location']}-{row['Destination Postal']}"
+    elif rate_type == 'LOCATION-REGION':
+        lane = f"{row['Source Location']}-{row['Destination Region']}"
+    else:
+        lane = "UNKNOWN"  # Default for unsupported or unexpected Rate Geographies
+
+    # Filter the price based on Lane and Adjusted Cost Type
+    price_row = price_df[(price_df['Lane'] == lane) & (price_df['Adjusted Cost Type'] == row['Adjusted Cost Type'])]
+
+    # Return the calculated cost and the price used
+    if not price_row.empty:
+        price = price_row.iloc[0]['Price']
+        if row['Cost Type'] == 'KM':
+            return row['Traveled Distance'] * price, price
+        elif row['Cost Type'] == 'KG':
+            return row['Weight'] * price, price
+        else:
+            return price, price
+    return None, None
+
+
+# Helper function to get the results of the original code for every shipment: the recalculated cost and price, and
+# the minimum simulation cost with the price and Rate Geography of its first column in the simulation order
+def original_results(historic_df, price_df):
+    historic_df = historic_df.copy()
+    historic_df['Adjusted Cost Type'] = historic_df.apply(
+        lambda row: row['Truck Type'] if row['Cost Type'] == 'EQUIPMENT' else row['Cost Type'], axis=1)
+    price_df = price_df.copy()
+    price_df['Lane'] = price_df['SOURCE'] + '-' + price_df['DESTINATION']
+    price_df['Adjusted Cost Type'] = price_df.apply(
+        lambda row: row['Truck Type'] if row['Cost Type'] == 'EQUIPMENT' else row['Cost Type'], axis=1)
+
+    expected = {}
+    for position, row in historic_df.iterrows():
+        recalculated = calculate_cost_and_price(row, price_df, row['Rate Geography'])
+        simulated = [calculate_cost_and_price(row, price_df, rate_type) for rate_type in ORIGINAL_SIMULATION_RATE_TYPES]
+        costs = pd.Series([cost for cost, _ in simulated], dtype=float)
+        minimum_cost = costs.min()
+        minimum = (np.nan, np.nan, None)
+        if pd.notnull(minimum_cost):
+            first = int(np.flatnonzero(costs.to_numpy() == minimum_cost)[0])
+            minimum = (minimum_cost, simulated[first][1], ORIGINAL_SIMULATION_RATE_TYPES[first])
+        expected[position] = {'Recalculated': (recalculated[0], recalculated[1], row['Rate Geography']),
+                              'Minimum_Simulation': minimum}
+    return expected
+
+
+# Helper function to get the (cost, price, Rate Geography) of every shipment and scenario from the long results,
+# NaN and None for the shipments left out without a price
+def results_by_shipment(results, shipments):
+    found = {(row['Shipment'], row['Scenario']): (row['Cost'], row['Price'], row['Rate Geography'])
+             for _, row in results.iterrows()}
+    return {shipment_position: {scenario: found.get((shipment_position, scenario), (np.nan, np.nan, None))
+                                for scenario in ['Recalculated', 'Minimum_Simulation']}
+            for shipment_position in shipments}
+
+
+# Helper function to compare a cost or price with the reference, None and NaN both stand for no value
+def same_value(value, expected):
+    if expected is None or pd.isna(expected):
+        return value is None or pd.isna(value)
+    return value == pytest.approx(expected)
+
+
+def historic_frame():
+    return pd.DataFrame(HISTORIC_ROWS)
+
+
+def price_frame(rows=PRICE_ROWS):
+    return pd.DataFrame(rows, columns=['SOURCE', 'DESTINATION', 'Cost Type', 'Truck Type', 'Price'])
+
+
+# Helper function to index a price list the way load_price_list does
+def lane_index(app, price_df):
+    price_df = price_df.copy()
+    price_df['Adjusted Cost Type'] = app.adjusted_cost_type(price_df)
+    return app.LaneIndex(price_df)
+
+
+# Helper function to write the fixture historic file and price lists as CSV files of a folder
+def write_inputs(folder, historic_df, price_dfs):
+    historic_df.to_csv(os.path.join(folder, 'historic.csv'), index=False)
+    price_list_files = []
+    for i, price_df in enumerate(price_dfs):
+        price_list_files.append(f'price{i + 1}.csv')
+        price_df.to_csv(os.path.join(folder, price_list_files[-1]), index=False)
+    return 'historic.csv', price_list_files
+
+
+# Function to generate a larger historic file and two price lists with the benchmark generators
+@pytest.fixture(scope='module')
+def generated(app):
+    import benchmark
+    rng = np.random.default_rng(7)
+    locations = benchmark.generate_locations(rng, locations=60, cities=20, regions=5)
+    historic_df = benchmark.generate_historic(rng, 400, locations)
+    price_dfs = [benchmark.generate_price_list(rng, historic_df, 300, 0.7, duplicates=0.05) for _ in range(2)]
+    return historic_df, price_dfs
+
+
+def test_vectorized_engine_matches_original_per_row_function(app):
+    historic_df = historic_frame()
+    price_df = price_frame()
+    expected = original_results(historic_df, price_df)
+
+    results, _ = app.calculate_carrier_results(app.prepare_historic(historic_df.copy()), lane_index(app, price_df))
+    actual = results_by_shipment(results, historic_df.index)
+
+    for position in historic_df.index:
+        for scenario in ['Recalculated', 'Minimum_Simulation']:
+            cost, price, rate_geography = actual[position][scenario]
+            expected_cost, expected_price, expected_geography = expected[position][scenario]
+            assert same_value(cost, expected_cost), (position, scenario)
+            assert same_value(price, expected_price), (position, scenario)
+            if not pd.isna(expected_price):
+                assert rate_geography == expected_geography, (position, scenario)
+
+    # The fixture exercises the cases it is meant to: the first of duplicated prices, a tie resolved in the
+    # simulation order, a missing Traveled Distance and a shipment without any price
+    assert actual[0]['Recalculated'][:2] == (200.0, 2.0)
+    assert actual[1]['Minimum_Simulation'] == (50.0, 1.0, 'CITY-CITY')
+    assert np.isnan(actual[3]['Recalculated'][0]) and actual[3]['Recalculated'][1] == 2.0
+    assert np.isnan(actual[5]['Minimum_Simulation'][1])
+
+
+def test_vectorized_engine_matches_original_on_generated_data(app, generated):
+    historic_df, price_dfs = generated
+    historic_df = historic_df.iloc[:120].copy()
+    historic_df.loc[historic_df.index[::7], 'Traveled Distance'] = np.nan
+    expected = original_results(historic_df, price_dfs[0])
+
+    results, _ = app.calculate_carrier_results(app.prepare_historic(historic_df.copy()), lane_index(app, price_dfs[0]))
+    actual = results_by_shipment(results, historic_df.index)
+    for position in historic_df.index:
+        for scenario in ['Recalculated', 'Minimum_Simulation']:
+            assert same_value(actual[position][scenario][0], expected[position][scenario][0]), (position, scenario)
+            assert same_value(actual[position][scenario][1], expected[position][scenario][1]), (position, scenario)
+
+
+# Helper function to load the results cube a run saved to its workspace
+def load_cube(app, workspace_id):
+    with open(os.path.join(app.workspace_path(workspace_id), app.CUBE_NAME + '.pkl'), 'rb') as f:
+        return pd.read_pickle(f)
+
+
+# Helper function to read the results file of a run in shipment order
+def load_results(app, result):
+    results = pd.read_csv(os.path.join(app.WORKSPACE_FOLDER, result['output_file']))
+    return results.sort_values('Shipment ID', kind='stable').reset_index(drop=True)
+
+
+# Helper function to sort the groups of a cube, sharding by hash may find them in another order and merged partial
+# totals do not keep the categorical group levels
+def sorted_cube(cube):
+    index = pd.MultiIndex.from_tuples(list(cube.historic.index), names=cube.historic.index.names)
+    historic = cube.historic.set_axis(index).sort_index()
+    return historic, cube.carriers.set_axis(index).reindex(historic.index)
+
+
+@pytest.mark.parametrize('mode', ['chunks', 'range', 'hash'])
+def test_chunked_and_sharded_runs_match_single_run(app, generated, mode, monkeypatch):
+    historic_df, price_dfs = generated
+    workspace_id = app.create_workspace()
+    folder = app.workspace_path(workspace_id)
+    historic_file, price_list_files = write_inputs(folder, historic_df, price_dfs)
+
+    single = app.run_processing(folder, workspace_id, historic_file, price_list_files, 'csv')
+    single_results, single_cube = load_results(app, single), load_cube(app, workspace_id)
+
+    monkeypatch.setitem(app.app.config, 'HISTORIC_CHUNK_SIZE', 70)
+    monkeypatch.setitem(app.app.config, 'SHARD_ROWS', 70)
+    monkeypatch.setitem(app.app.config, 'SHARD_COUNT', 3)
+    monkeypatch.setitem(app.app.config, 'SHARD_WORKERS', 2 if mode == 'hash' else 1)
+    if mode == 'chunks':
+        monkeypatch.setitem(app.app.config, 'STREAMING_THRESHOLD_BYTES', 0)
+    split = app.run_processing(folder, workspace_id, historic_file, price_list_files, 'csv',
+                               shard_mode='' if mode == 'chunks' else mode)
+
+    pd.testing.assert_frame_equal(load_results(app, split), single_results)
+    split_historic, split_carriers = sorted_cube(load_cube(app, workspace_id))
+    single_historic, single_carriers = sorted_cube(single_cube)
+    pd.testing.assert_series_equal(split_historic, single_historic)
+    pd.testing.assert_frame_equal(split_carriers, single_carriers)
+
+
+# Helper function to turn a historic row into the JSON shipment of the quote route
+def quote_request(row):
+    return {column: None if pd.isna(value) else value for column, value in row.items()}
+
+
+@pytest.mark.parametrize('lookup_mode', ['exact', 'fallback'])
+def test_quote_matches_batch_results(app, generated, lookup_mode):
+    generated_df, price_dfs = generated
+    historic_df = pd.concat([historic_frame(), generated_df.iloc[:150]], ignore_index=True)
+    price_df = pd.concat([price_frame(), price_dfs[0]], ignore_index=True)
+    index = lane_index(app, price_df)
+
+    results, _ = app.calculate_carrier_results(app.prepare_historic(historic_df.copy()), index, lookup_mode)
+    expected = results_by_shipment(results, historic_df.index)
+    quote_table = app.QuoteTable(index)
+
+    for position, row in historic_df.iterrows():
+        quote = app.quote_shipment(quote_request(row), quote_table, lookup_mode)
+        for scenario, key in [('Recalculated', 'recalculated'), ('Minimum_Simulation', 'minimum_simulation')]:
+            expected_cost, expected_price, expected_geography = expected[position][scenario]
+            if np.isnan(expected_price):
+                assert quote[key] is None or np.isnan(quote[key]['price']), (position, scenario)
+                continue
+            assert quote[key]['price'] == pytest.approx(expected_price), (position, scenario)
+            assert same_value(quote[key]['cost'], expected_cost), (position, scenario)
+            assert quote[key]['rate_geography'] == expected_geography, (position, scenario)
+
+
+def test_sweep_point_matches_edited_price_list(app, generated):
+    historic_df, price_dfs = generated
+    historic_df = app.prepare_historic(historic_df.copy())
+    lane_indexes = [lane_index(app, price_df) for price_df in price_dfs]
+    carrier_names, results = app.calculate_all_carriers(historic_df, lane_indexes)
+
+    points = [{'carrier2': 0.9}, {'carrier1': {'KM': 1.1, 'FTL': 0.8}, 'carrier2': 1.05}]
+    # The breakdowns of the scenario sheets, the ones run_sweep evaluates
+    for group_by in dict.fromkeys(group_by for _, group_by, _, _ in app.SCENARIO_SHEETS):
+        swept = app.sweep_totals(historic_df, results, carrier_names, group_by, app.RESULT_SCENARIOS, points)
+
+        for point, point_totals in zip(points, swept):
+            # Apply the point to the price lists themselves and recalculate
+            edited = []
+            for carrier_name, price_df in zip(carrier_names, price_dfs):
+                price_df = price_df.copy()
+                adjustment = point.get(carrier_name, 1.0)
+                cost_types = app.adjusted_cost_type(price_df)
+                factors = cost_types.map(adjustment).fillna(1.0) if isinstance(adjustment, dict) else adjustment
+                price_df['Price'] = price_df['Price'] * factors
+                edited.append(lane_index(app, price_df))
+            _, edited_results = app.calculate_all_carriers(historic_df, edited)
+            expected = app.aggregate_totals(historic_df, edited_results, carrier_names, group_by)
+
+            pd.testing.assert_series_equal(point_totals.historic, expected.historic)
+            pd.testing.assert_frame_equal(point_totals.carriers, expected.carriers, check_exact=False, rtol=1e-9)